@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Скрипт для замера производительности загрузки и обработки звонков
+
+По умолчанию работает с эмуляцией API ВАТС (фиксированная задержка на запрос),
+с флагом --live - с реальным API из .env.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from datetime import datetime, timedelta
+
+import broker_call_bot as bot
+from call_cache import estimate_size
+from call_records import CallRecords
+from excel_writer import write_frame
+from call_stats import INCOMING_TYPES, OUTGOING_TYPES, MISSED_STATUSES, summarize_calls
+from vats_client import iter_json_calls
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.status_code = 200
+        self.text = ''
+        self._body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+    def json(self):
+        return json.loads(self._body)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self._body), chunk_size):
+            yield self._body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def make_employees(departments, per_department):
+    """Синтетический список сотрудников в формате EmployeeDataProvider"""
+    employees = []
+    for dept in range(1, departments + 1):
+        for i in range(per_department):
+            employees.append({
+                'last_name': f"Сотрудник{dept}_{i}",
+                'first_name': 'Тест',
+                'department': str(dept),
+                'sim': f"79{dept:02d}{i:07d}"
+            })
+    return employees
+
+
+def make_calls(employees, start_date, end_date, calls_per_employee):
+    """Синтетические звонки в формате API ВАТС"""
+    rnd = random.Random(42)
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    days = (datetime.strptime(end_date, "%Y-%m-%d") - start).days + 1
+    calls = []
+    for emp in employees:
+        for _ in range(calls_per_employee):
+            call_type = rnd.choice(['in', 'out'])
+            client = f"79{rnd.randint(100000000, 999999999)}"
+            calls.append({
+                'id': f"call_{len(calls)}",
+                'type': call_type,
+                'status': rnd.choice(['answered', 'missed', 'noanswer']),
+                'start': (start + timedelta(days=rnd.randrange(days), seconds=rnd.randrange(86400))).strftime("%Y-%m-%d %H:%M:%S"),
+                'duration': rnd.randint(0, 600),
+                'from': client if call_type == 'in' else emp['sim'],
+                'to': emp['sim'] if call_type == 'in' else client,
+            })
+    calls.sort(key=lambda call: call['start'])
+    return calls
+
+
+def install_fake_api(calls, latency, row_cost=0.0):
+    """
+    Подменяет запросы VatsClient эмуляцией; возвращает счётчик запросов
+
+    Задержка ответа: latency секунд плюс row_cost секунд на каждую запись страницы.
+    """
+    by_phone = {}
+    for call in calls:
+        by_phone.setdefault(call['from'], []).append(call)
+        by_phone.setdefault(call['to'], []).append(call)
+    counter = {'requests': 0}
+
+    def fake_get(path, params=None, headers=None, timeout=None, stream=False):
+        counter['requests'] += 1
+        source = by_phone.get(params['phone'], []) if params.get('phone') else calls
+        first_day, last_day = params['start_date'], params['end_date']
+        source = [call for call in source if first_day <= call['start'][:10] <= last_day]
+        page, limit = params['page'], params['limit']
+        rows = source[(page - 1) * limit:page * limit]
+        time.sleep(latency + row_cost * len(rows))
+        return FakeResponse({'result': rows})
+
+    bot.vats_client.get = fake_get
+    return counter
+
+
+def setup_employees(args):
+    """Сотрудники и счётчик запросов: реальное API (--live) или эмуляция"""
+    if args.live:
+        employees = [e for e in bot.employee_provider.get_employees() if e.get('sim')]
+        counter = {'requests': 0}
+        original_get = bot.vats_client.get
+
+        def counting_get(*a, **kw):
+            counter['requests'] += 1
+            return original_get(*a, **kw)
+
+        bot.vats_client.get = counting_get
+    else:
+        employees = make_employees(args.departments, args.per_department)
+        calls = make_calls(employees, args.start, args.end, args.calls)
+        counter = install_fake_api(calls, args.latency, args.row_cost)
+    return employees, counter
+
+
+def bench_fetch(args):
+    """Сравнение загрузки по каждой SIM и массовой загрузки за период"""
+    employees, counter = setup_employees(args)
+    print(f"Сотрудников: {len(employees)}, период {args.start} - {args.end}")
+    for mode, bulk in (("по SIM", False), ("массово", True)):
+        counter['requests'] = 0
+        started = time.monotonic()
+        summaries = asyncio.run(bot.fetch_call_histories(employees, args.start, args.end, summarize=True, bulk=bulk))
+        elapsed = time.monotonic() - started
+        total = sum(s['total'] for s in summaries)
+        print(f"{mode:>10}: {elapsed:7.2f} с, запросов {counter['requests']:5d}, звонков {total}")
+
+
+def bench_split(args):
+    """Загрузка длинного периода целиком и частями по --split-days дней"""
+    employees, counter = setup_employees(args)
+    print(f"Сотрудников: {len(employees)}, период {args.start} - {args.end}")
+    for split_days in (0, args.split_days):
+        bot.SPLIT_RANGE_DAYS = split_days
+        counter['requests'] = 0
+        started = time.monotonic()
+        summaries = asyncio.run(bot.fetch_call_histories(employees, args.start, args.end, summarize=True, bulk=False))
+        elapsed = time.monotonic() - started
+        total = sum(s['total'] for s in summaries)
+        mode = f"по {split_days} дн." if split_days else "целиком"
+        print(f"{mode:>10}: {elapsed:7.2f} с, запросов {counter['requests']:5d}, звонков {total}")
+
+
+def bench_parse(args):
+    """Пиковая память разбора одного большого ответа: response.json() и потоковый разбор"""
+    employees = make_employees(args.departments, args.per_department)
+    calls = make_calls(employees, args.start, args.end, args.calls)
+    response = FakeResponse({'status': 'ok', 'result': calls})
+    del calls
+    print(f"Ответ: {len(response._body) / 2**20:.1f} МБ, звонков {args.departments * args.per_department * args.calls}")
+    parsers = (
+        ("json()", lambda: summarize_calls(response.json()['result'])),
+        ("поток", lambda: summarize_calls(iter_json_calls(response.iter_content(bot.vats_client.STREAM_CHUNK_SIZE)))),
+    )
+    for mode, parse in parsers:
+        tracemalloc.start()
+        started = time.monotonic()
+        summary = parse()
+        elapsed = time.monotonic() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{mode:>10}: {elapsed:7.2f} с, пик памяти {peak / 2**20:7.1f} МБ, звонков {summary['total']}")
+
+
+def summarize_dataframe(calls):
+    """Прежний подсчёт: DataFrame на сотрудника и три прохода .str.lower().isin"""
+    df = pd.DataFrame(calls)
+    if df.empty:
+        return {'incoming': 0, 'outgoing': 0, 'missed': 0, 'total': 0}
+    return {
+        'incoming': df[df['type'].str.lower().isin(INCOMING_TYPES)].shape[0],
+        'outgoing': df[df['type'].str.lower().isin(OUTGOING_TYPES)].shape[0],
+        'missed': df[df['status'].str.lower().isin(MISSED_STATUSES)].shape[0],
+        'total': len(calls)
+    }
+
+
+def bench_aggregate(args):
+    """Подсчёт статистики по сотрудникам и отделам: прежний DataFrame на сотрудника и проход по звонкам"""
+    employees = make_employees(args.departments, args.per_department)
+    calls = make_calls(employees, args.start, args.end, args.calls)
+    by_phone = {}
+    for call in calls:
+        by_phone.setdefault(call['to'] if call['type'] == 'in' else call['from'], []).append(call)
+    histories = [by_phone.get(employee['sim'], []) for employee in employees]
+    print(f"Сотрудников: {len(employees)}, звонков {len(calls)}")
+
+    engines = (
+        ("DataFrame", lambda: [summarize_dataframe(calls) for calls in histories]),
+        ("проход", lambda: [summarize_calls(calls) for calls in histories]),
+    )
+    expected = None
+    for mode, engine in engines:
+        started = time.monotonic()
+        summaries = engine()
+        df_stats = pd.DataFrame(bot.build_employee_stats(employees, summaries))
+        departments = bot.department_totals(df_stats)
+        elapsed = time.monotonic() - started
+        # Сравниваются только счётчики: гистограммы длительности считает лишь проход по звонкам
+        result = departments[['Отдел', 'Сотрудников', *bot.STAT_COLUMNS]].to_dict('records')
+        expected = expected or result
+        match = "совпадает" if result == expected else "РАСХОДИТСЯ"
+        print(f"{mode:>10}: {elapsed:7.3f} с, отделов {len(departments)}, итог {match}")
+
+
+def bench_records(args):
+    """Память: списки словарей и колоночные CallRecords"""
+    employees = make_employees(args.departments, args.per_department)
+    # Круг через JSON: строки в словарях - отдельные объекты, как в ответе API
+    calls = json.loads(json.dumps(make_calls(employees, args.start, args.end, args.calls)))
+    by_phone = {}
+    for call in calls:
+        by_phone.setdefault(call['to'] if call['type'] == 'in' else call['from'], []).append(call)
+    histories = [by_phone.get(employee['sim'], []) for employee in employees]
+
+    started = time.monotonic()
+    records = [CallRecords.from_calls(calls) for calls in histories]
+    built = time.monotonic() - started
+    dict_bytes = sum(estimate_size(calls) for calls in histories)
+    record_bytes = sum(r.nbytes for r in records)
+    print(f"Сотрудников: {len(employees)}, звонков {len(calls)}, сборка CallRecords {built:.2f} с")
+    print(f"   словари: {dict_bytes / 2**20:7.1f} МБ ({dict_bytes / len(calls):.0f} байт на звонок)")
+    print(f"   колонки: {record_bytes / 2**20:7.1f} МБ ({record_bytes / len(calls):.0f} байт на звонок), "
+          f"в {dict_bytes / record_bytes:.1f} раза меньше")
+
+
+def excel_summary_concat(df_stats, report_type):
+    """Прежняя сборка таблицы Excel: pd.concat в цикле по отделам"""
+    if report_type == "all":
+        excel_df = pd.DataFrame()
+        required_columns = ['Отдел', 'Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']
+        for column in required_columns:
+            if column not in df_stats.columns:
+                df_stats[column] = 0
+        for dept in df_stats['Отдел'].unique():
+            dept_data = df_stats[df_stats['Отдел'] == dept]
+            dept_total = dept_data[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
+            num_employees = len(dept_data) if len(dept_data) else 1
+            excel_df = pd.concat([excel_df, pd.DataFrame([{
+                'Отдел': dept,
+                'Входящие 📞': f"{dept_total['Входящие 📞']} ({round(dept_total['Входящие 📞']/num_employees, 1)})",
+                'Исходящие 📤': f"{dept_total['Исходящие 📤']} ({round(dept_total['Исходящие 📤']/num_employees, 1)})",
+                'Пропущенные ❌': f"{dept_total['Пропущенные ❌']} ({round(dept_total['Пропущенные ❌']/num_employees, 1)})"
+            }])], ignore_index=True)
+        total = df_stats[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
+        excel_df = pd.concat([excel_df, pd.DataFrame([{
+            'Отдел': 'ИТОГО ВСЕГО',
+            'Входящие 📞': total['Входящие 📞'],
+            'Исходящие 📤': total['Исходящие 📤'],
+            'Пропущенные ❌': total['Пропущенные ❌']
+        }])], ignore_index=True)
+    else:
+        excel_df = df_stats.copy()
+        # Переупорядочиваем колонки для отчета по отделам
+        # Первым столбцом должна быть фамилия и имя сотрудника
+        column_order = ['Сотрудник', 'Отдел', 'Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌', 'Всего звонков']
+        # Добавляем колонки, которых может не быть
+        for col in column_order:
+            if col not in excel_df.columns:
+                excel_df[col] = 0
+        # Переупорядочиваем колонки
+        excel_df = excel_df[column_order]
+
+        for dept in df_stats['Отдел'].unique():
+            dept_data = df_stats[df_stats['Отдел'] == dept]
+            dept_total = dept_data[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
+            excel_df = pd.concat([excel_df, pd.DataFrame([{
+                'Сотрудник': f'ИТОГО {dept}',
+                'Отдел': dept,
+                'Входящие 📞': dept_total['Входящие 📞'],
+                'Исходящие 📤': dept_total['Исходящие 📤'],
+                'Пропущенные ❌': dept_total['Пропущенные ❌'],
+                'Всего звонков': dept_total['Входящие 📞'] + dept_total['Исходящие 📤'] + dept_total['Пропущенные ❌']
+            }])], ignore_index=True)
+        total = df_stats[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
+        excel_df = pd.concat([excel_df, pd.DataFrame([{
+            'Сотрудник': 'ИТОГО ВСЕГО',
+            'Отдел': '',
+            'Входящие 📞': total['Входящие 📞'],
+            'Исходящие 📤': total['Исходящие 📤'],
+            'Пропущенные ❌': total['Пропущенные ❌'],
+            'Всего звонков': total['Входящие 📞'] + total['Исходящие 📤'] + total['Пропущенные ❌']
+        }])], ignore_index=True)
+    return excel_df
+
+
+def make_stats(departments, per_department):
+    """Синтетическая статистика сотрудников в формате build_employee_stats"""
+    rnd = random.Random(7)
+    employees = make_employees(departments, per_department)
+    summaries = []
+    for _ in employees:
+        incoming, outgoing, missed = rnd.randint(0, 300), rnd.randint(0, 300), rnd.randint(0, 80)
+        summaries.append({'incoming': incoming, 'outgoing': outgoing, 'missed': missed, 'total': incoming + outgoing})
+    # Сотрудники без номера отдела
+    employees[1]['department'] = employees[-2]['department'] = 'Не указан'
+    return pd.DataFrame(bot.build_employee_stats(employees, summaries))
+
+
+def bench_excel(args):
+    """Таблица Excel-отчёта: pd.concat в цикле по отделам и один groupby"""
+    df_stats = make_stats(args.departments, args.per_department)
+    print(f"Отделов: {df_stats['Отдел'].nunique(dropna=False)}, сотрудников: {len(df_stats)}")
+    for report_type in ("all", "by"):
+        timings = {}
+        results = {}
+        for mode, build in (("concat", excel_summary_concat), ("groupby", bot.build_excel_summary)):
+            # Лучшее из пяти запусков
+            runs = []
+            for _ in range(5):
+                started = time.monotonic()
+                results[mode] = build(df_stats.copy(), report_type)
+                runs.append(time.monotonic() - started)
+            timings[mode] = min(runs)
+        # Отличие допустимо только в итоге отдела для сотрудников без номера отдела: раньше он был нулевым
+        # Колонки перцентилей длительности прежняя сборка не строила
+        old, new = results['concat'], results['groupby']
+        new = new[old.columns]
+        known = old['Отдел'].notna()
+        if 'Сотрудник' in old:
+            known |= ~old['Сотрудник'].str.startswith('ИТОГО')
+        # Сравниваются значения ячеек: строковый dtype колонки на содержимое Excel не влияет
+        same = old.shape == new.shape and old[known].astype(object).equals(new[known].astype(object))
+        print(f"{report_type:>4}: concat {timings['concat']:.3f} с, groupby {timings['groupby']:.3f} с, "
+              f"строк {len(new)}, {'совпадает' if same else 'РАСХОДИТСЯ'}")
+
+
+def incoming_excel_concat(employees, histories, filepath):
+    """Прежний отчёт по входящим номерам: таблица на сотрудника, pd.concat, сортировка и запись DataFrame"""
+    frames = []
+    for employee, records in zip(employees, histories):
+        incoming = records.incoming()
+        if not incoming.any():
+            continue
+        frames.append(pd.DataFrame({
+            'Сотрудник': f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip(),
+            'Отдел': bot.get_department_numbers(employee['department']),
+            'Входящий номер': records.column('from', incoming),
+            'Дата/время': records.column('start', incoming),
+            'Длительность': records.column('duration', incoming),
+            'Статус': records.column('status', incoming)
+        }))
+    df = pd.concat(frames, ignore_index=True).fillna('Неизвестно').sort_values('Дата/время', ascending=False)
+    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Отчет', index=False)
+        worksheet = writer.sheets['Отчет']
+        for column in worksheet.columns:
+            width = max(len(str(cell.value)) for cell in column)
+            worksheet.column_dimensions[column[0].column_letter].width = min(width + 2, 50)
+    return len(df)
+
+
+def bench_incoming(args):
+    """Отчёт по входящим номерам: pd.concat с сортировкой и потоковая запись со слиянием по времени"""
+    employees = make_employees(args.departments, args.per_department)
+    calls = make_calls(employees, args.start, args.end, args.calls)
+    by_phone = {}
+    for call in calls:
+        by_phone.setdefault(call['to'] if call['type'] == 'in' else call['from'], []).append(call)
+    histories = [CallRecords.from_calls(by_phone.get(employee['sim'], [])) for employee in employees]
+    print(f"Сотрудников: {len(employees)}, звонков {len(calls)}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, write in (("concat", incoming_excel_concat), ("поток", bot.write_incoming_excel)):
+            filepath = os.path.join(directory, f"{mode}.xlsx")
+            tracemalloc.start()
+            started = time.monotonic()
+            rows = write(employees, histories, filepath) if mode == "concat" else write(filepath, employees, histories)
+            elapsed = time.monotonic() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[mode] = pd.read_excel(filepath, dtype=str)
+            print(f"{mode:>10}: {elapsed:6.2f} с, пик памяти {peak / 2**20:6.1f} МБ, строк {rows}")
+    # Порядок звонков с одинаковым временем не определён: сравниваются отсортированные строки
+    old, new = (frame.sort_values(list(frame.columns), ignore_index=True) for frame in results.values())
+    ordered = results["поток"]['Дата/время'].is_monotonic_decreasing
+    print(f"Содержимое {'совпадает' if old.equals(new) else 'РАСХОДИТСЯ'}, "
+          f"сортировка по времени {'верная' if ordered else 'НАРУШЕНА'}")
+
+
+def write_frame_autofit(filepath, df, sheet_name='Отчет'):
+    """Прежняя запись DataFrame: pd.ExcelWriter в обычном режиме и второй обход всех ячеек для ширины колонок"""
+    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+        worksheet = writer.sheets[sheet_name]
+        for column in worksheet.columns:
+            width = max(len(str(cell.value)) for cell in column)
+            worksheet.column_dimensions[column[0].column_letter].width = min(width + 2, 50)
+
+
+def bench_workbook(args):
+    """Запись DataFrame в Excel: обычный режим openpyxl с автоподбором ширины и потоковая запись write_only"""
+    rnd = random.Random(5)
+    start = datetime.strptime(args.start, "%Y-%m-%d")
+    df = pd.DataFrame({
+        'Сотрудник': [f"Сотрудник{rnd.randint(1, 300)} Тест" for _ in range(args.rows)],
+        'Отдел': [str(rnd.randint(1, 18)) for _ in range(args.rows)],
+        'Входящий номер': [f"79{rnd.randint(100000000, 999999999)}" for _ in range(args.rows)],
+        'Дата/время': [(start + timedelta(seconds=rnd.randrange(30 * 86400))).strftime("%Y-%m-%d %H:%M:%S") for _ in range(args.rows)],
+        'Длительность': [rnd.randint(0, 600) for _ in range(args.rows)],
+        'Статус': [rnd.choice(['answered', 'missed', 'noanswer']) for _ in range(args.rows)],
+    })
+    print(f"Строк: {len(df)}")
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, write in (("обычный", write_frame_autofit), ("поток", write_frame)):
+            filepath = os.path.join(directory, f"{mode}.xlsx")
+            # Время - без трассировки памяти, пик памяти - отдельным запуском под tracemalloc
+            started = time.monotonic()
+            write(filepath, df)
+            elapsed = time.monotonic() - started
+            tracemalloc.start()
+            write(filepath, df)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[mode] = pd.read_excel(filepath)
+            print(f"{mode:>10}: {elapsed:6.2f} с, пик памяти {peak / 2**20:6.1f} МБ, файл {os.path.getsize(filepath) / 2**20:.1f} МБ")
+    print(f"Содержимое {'совпадает' if results['обычный'].equals(results['поток']) else 'РАСХОДИТСЯ'}")
+
+
+def main():
+    today = datetime.now().date()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--live', action='store_true', help="использовать реальное API ВАТС")
+    parser.add_argument('--start', default=(today - timedelta(days=30)).strftime("%Y-%m-%d"))
+    parser.add_argument('--end', default=today.strftime("%Y-%m-%d"))
+    parser.add_argument('--departments', type=int, default=18)
+    parser.add_argument('--per-department', type=int, default=15)
+    parser.add_argument('--calls', type=int, default=150, help="звонков на сотрудника (эмуляция)")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка эмулируемого API, с")
+    parser.add_argument('--row-cost', type=float, default=0.0001, help="время выборки одной записи в эмуляции, с")
+    parser.add_argument('--rows', type=int, default=100000, help="строк таблицы для команды workbook")
+    parser.add_argument('--split-days', type=int, default=7, help="размер части периода для команды split")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('fetch', help=bench_fetch.__doc__).set_defaults(func=bench_fetch)
+    sub.add_parser('split', help=bench_split.__doc__).set_defaults(func=bench_split)
+    sub.add_parser('parse', help=bench_parse.__doc__).set_defaults(func=bench_parse)
+    sub.add_parser('aggregate', help=bench_aggregate.__doc__).set_defaults(func=bench_aggregate)
+    sub.add_parser('records', help=bench_records.__doc__).set_defaults(func=bench_records)
+    sub.add_parser('excel', help=bench_excel.__doc__).set_defaults(func=bench_excel)
+    sub.add_parser('incoming', help=bench_incoming.__doc__).set_defaults(func=bench_incoming)
+    sub.add_parser('workbook', help=bench_workbook.__doc__).set_defaults(func=bench_workbook)
+    args = parser.parse_args()
+
+    # Замеряется загрузка из API: кэш в памяти и локальное хранилище отключены
+    bot.call_cache = None
+    bot.call_store = None
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,9 @@ import requests
 import pandas as pd
 import matplotlib.pyplot as plt
 import calendar
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
 from io import BytesIO
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
@@ -25,13 +25,28 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import asyncio
+import heapq
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
 load_dotenv()
 
 # Импортирую EmployeeDataProvider
-from employee_data_provider import EmployeeDataProvider
+from employee_data_provider import EmployeeDataProvider, build_phone_index, match_call_employees, normalize_phone
+from vats_client import VatsClient, RateLimiter, CircuitBreaker, VatsUnavailableError
+from call_stats import empty_summary, add_call, merge_summary, summarize_calls, summarize_calls_by, talk_percentiles
+from call_store import CallStore, iter_days, group_day_runs, split_day_range, call_day, run_day
+from call_cache import CallCache
+from call_records import CallRecords, hour_weekday_counts
+from duration_sketch import merge_sketches
+from excel_writer import StreamingWorkbook, ColumnWidths, GREY_HEADER, TOTAL_ROW, write_frame
+from hyperloglog import HyperLogLog
+from single_flight import SingleFlight
+from today_counters import TodayCounters
 
 # Инициализация colorama
 init(autoreset=True)
@@ -57,6 +72,47 @@ logger = logging.getLogger(__name__)
 API_KEY = os.getenv("API_KEY", "d1b0ef65-e491-43f9-967b-df67d4657dbb")
 API_URL = os.getenv("API_URL", "https://leto.megapbx.ru/crmapi/v1")
 
+# Максимальное число одновременных запросов истории звонков
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))
+# Отдельный пул потоков, чтобы загрузка звонков не занимала пул по умолчанию
+_fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="vats-fetch")
+
+# Массовая загрузка: один постраничный запрос на весь период вместо запроса на каждую SIM
+BULK_FETCH = os.getenv("BULK_FETCH", "0").lower() in ("1", "true", "yes")
+
+# Объединение одинаковых одновременных запросов истории звонков:
+# между потоками (SingleFlight) и между обработчиками в цикле событий (ожидающие future)
+_call_flight = SingleFlight()
+_inflight_fetches = {}
+
+# Деление длинных периодов на части по N дней, загружаемые параллельно (0 - не делить)
+SPLIT_RANGE_DAYS = int(os.getenv("SPLIT_RANGE_DAYS", "0"))
+# Отдельный пул для частей периода: задачи основного пула ждут их завершения
+_split_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="vats-split")
+
+# Таймауты API ВАТС в секундах: на установку соединения и на чтение ответа
+VATS_CONNECT_TIMEOUT = float(os.getenv("VATS_CONNECT_TIMEOUT", "5"))
+VATS_READ_TIMEOUT = float(os.getenv("VATS_READ_TIMEOUT", "30"))
+
+# Квота API ВАТС: запросов в секунду (0 - без ограничения) и одновременных запросов на процесс
+VATS_RATE_LIMIT = float(os.getenv("VATS_RATE_LIMIT", "10"))
+VATS_MAX_CONCURRENT = int(os.getenv("VATS_MAX_CONCURRENT", str(FETCH_CONCURRENCY)))
+
+# Автомат защиты: сколько ошибок подряд размыкают его и через сколько секунд пробовать снова
+VATS_BREAKER_THRESHOLD = int(os.getenv("VATS_BREAKER_THRESHOLD", "5"))
+VATS_BREAKER_RESET_TIMEOUT = float(os.getenv("VATS_BREAKER_RESET_TIMEOUT", "60"))
+
+# Общий клиент API ВАТС (пул соединений не меньше числа параллельных запросов).
+# Ограничитель общий для всех обработчиков и фоновых задач
+vats_client = VatsClient(
+    API_KEY, API_URL,
+    pool_size=max(FETCH_CONCURRENCY, VATS_MAX_CONCURRENT),
+    connect_timeout=VATS_CONNECT_TIMEOUT,
+    read_timeout=VATS_READ_TIMEOUT,
+    rate_limiter=RateLimiter(VATS_RATE_LIMIT, max_concurrent=VATS_MAX_CONCURRENT),
+    circuit_breaker=CircuitBreaker(VATS_BREAKER_THRESHOLD, VATS_BREAKER_RESET_TIMEOUT)
+)
+
 # Список разрешенных пользователей
 ALLOWED_USERS_STR = os.getenv("ALLOWED_USERS", "194530,368752085,261337953,702018715")
 ALLOWED_USERS = [int(user_id.strip()) for user_id in ALLOWED_USERS_STR.split(",")]
@@ -67,6 +123,33 @@ AUTO_REPORT_USER_ID = int(os.getenv("AUTO_REPORT_USER_ID", "194530"))
 # Глобальная переменная для приложения бота (нужна для планировщика)
 bot_application = None
 
+# Локальное хранилище истории звонков (пустой путь отключает хранилище)
+CALL_STORE_PATH = os.getenv("CALL_STORE_PATH", "data/call_history.db")
+call_store = CallStore(CALL_STORE_PATH) if CALL_STORE_PATH else None
+
+# Кэш истории звонков в памяти: размер в МБ (0 отключает) и время жизни записей за текущий день
+CALL_CACHE_MB = int(os.getenv("CALL_CACHE_MB", "64"))
+CALL_CACHE_TODAY_TTL = int(os.getenv("CALL_CACHE_TODAY_TTL", "120"))
+call_cache = CallCache(CALL_CACHE_MB * 1024 * 1024, CALL_CACHE_TODAY_TTL) if CALL_CACHE_MB > 0 else None
+
+# Ночная предзагрузка звонков за прошедший день в кэш и хранилище:
+# время запуска HH:MM по времени сервера (пусто - отключена) и число одновременных запросов
+PREFETCH_TIME = os.getenv("PREFETCH_TIME", "05:00").strip()
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "4"))
+
+# Отчёт "Уникальные клиенты": периоды до стольких дней считаются точно по звонкам,
+# длиннее - приблизительно по дневным регистрам HyperLogLog из хранилища
+UNIQUE_EXACT_DAYS = int(os.getenv("UNIQUE_EXACT_DAYS", "7"))
+
+# Файлы отчётов собираются в памяти; больше стольких МБ - во временном файле с уникальным именем
+REPORT_SPOOL_MB = int(os.getenv("REPORT_SPOOL_MB", "32"))
+
+# Счётчики звонков за сегодня: интервал опроса API в секундах (0 - отчёт "Сегодня" загружается целиком)
+TODAY_POLL_INTERVAL = int(os.getenv("TODAY_POLL_INTERVAL", "60"))
+today_counters = TodayCounters(
+    lambda day, page, page_size: vats_client.get_calls_page(day, day, None, page, page_size)
+) if TODAY_POLL_INTERVAL > 0 else None
+
 # Инициализация провайдера сотрудников (глобально)
 EMPLOYEE_API_TOKEN = os.getenv("EMPLOYEE_API_TOKEN", "a4d4a75094d8f9d8597085ac0ac12a51")
 employee_provider = EmployeeDataProvider(EMPLOYEE_API_TOKEN)
@@ -196,6 +279,10 @@ async def button_callback(update, context):
         
         if format_type == "incoming":
             await handle_incoming_numbers_excel(query, context, sheet_type, dept_number, period)
+        elif format_type == "unique":
+            await handle_unique_callers(query, context, dept_number, period)
+        elif format_type == "heatmap":
+            await handle_heatmap_format(query, context, dept_number, period)
         else:
             await handle_report_format(query, context, sheet_type, dept_number, period, format_type)
         return
@@ -334,9 +421,11 @@ async def show_format_selection(query, context, sheet_type, report_type, dept_nu
     
     keyboard = [
         [InlineKeyboardButton("📊 График", callback_data="format:plot")],
+        [InlineKeyboardButton("🗓 Тепловая карта", callback_data="format:heatmap")],
         [InlineKeyboardButton("📋 Таблица", callback_data="format:table")],
         [InlineKeyboardButton("📑 Excel", callback_data="format:excel")],
         [InlineKeyboardButton("📞 Входящие номера", callback_data="format:incoming")],
+        [InlineKeyboardButton("👥 Уникальные клиенты", callback_data="format:unique")],
         [InlineKeyboardButton("📊 Все форматы", callback_data="format:all")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
     ]
@@ -387,52 +476,22 @@ async def handle_report_format(query, context, sheet_type, dept_number, period,
             logger.info(f"Отфильтровано {len(filtered)} сотрудников для отдела {dept_number}")
 
         # Собираем статистику по сотрудникам
-        all_stats = []
-        total_employees = len(filtered)
-        current_employee = 0
+        filtered = [employee for employee in filtered if employee.get('sim') and employee['sim'] != 'Нет данных']
         
-        for employee in filtered:
-            if not employee.get('sim') or employee['sim'] == 'Нет данных':
-                continue
-            
-            current_employee += 1
-            
-            # Обновляем прогресс-бар
-            progress = (current_employee / total_employees) * 100
-            progress_bar = "█" * int(progress / 2) + "░" * (50 - int(progress / 2))
-            progress_text = (
-                f"🔄 Формирую отчет...\n"
-                f"Прогресс: {progress_bar} {progress:.1f}%\n"
-                f"Обработано сотрудников: {current_employee}/{total_employees}\n"
-                f"Текущий: {employee.get('last_name', '')} {employee.get('first_name', '')}"
+        as_of = None
+        if period == "today" and today_counters is not None and today_counters.is_fresh(TODAY_POLL_INTERVAL * 3):
+            # Отчёт за сегодня - из счётчиков, обновляемых фоновым опросом
+            summaries = today_counters.summaries([employee['sim'] for employee in filtered])
+            as_of = today_counters.updated_at.strftime("%H:%M:%S")
+        else:
+            # Получаем данные звонков параллельно
+            summaries = await fetch_call_histories(
+                filtered, start_date_str, end_date_str,
+                on_progress=make_fetch_progress(query, "🔄 Формирую отчет..."),
+                summarize=True
             )
-            await safe_edit_message(query, progress_text, reply_markup=None)
-            
-            # Получаем данные звонков
-            data = fetch_call_history(start_date_str, end_date_str, employee['sim'])
-            if not data:
-                continue
-                
-            # Подсчитываем статистику
-            df = pd.DataFrame(data)
-            if not df.empty:
-                incoming_types = ['in', 'incoming', 'received', 'inbound', 'входящий']
-                outgoing_types = ['out', 'outgoing', 'исходящий']
-                missed_statuses = ['noanswer', 'missed', 'пропущен', 'неотвечен', 'нет ответа']
-
-                incoming_count = df[df['type'].str.lower().isin(incoming_types)].shape[0]
-                outgoing_count = df[df['type'].str.lower().isin(outgoing_types)].shape[0]
-                missed_count = df[df['status'].str.lower().isin(missed_statuses)].shape[0] if 'status' in df.columns else 0
-                    
-                stats_dict = {
-                    'Сотрудник': f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip(),
-                    'Отдел': get_department_numbers(employee['department']),
-                    'Входящие 📞': incoming_count,
-                    'Исходящие 📤': outgoing_count,
-                    'Пропущенные ❌': missed_count,
-                    'Всего звонков': len(data)
-                }
-                all_stats.append(stats_dict)
+        
+        all_stats = build_employee_stats(filtered, summaries)
         
         if not all_stats:
             logger.error("Нет данных для создания отчета")
@@ -446,8 +505,8 @@ async def handle_report_format(query, context, sheet_type, dept_number, period,
         
         # Обрабатываем формат отчета
         if format_type == "all":
-            await handle_table_format(query, context, all_stats, "Отчет")
-            await handle_plot_format(query, context, df_stats, "Отчет")
+            await handle_table_format(query, context, all_stats, "Отчет", as_of)
+            await handle_plot_format(query, context, df_stats, "Отчет", as_of)
             await handle_excel_format(query, context, df_stats, "Отчет", period)
             period_info = get_period_dates_info(period, context)
             await safe_edit_message(query, f"✅ Все форматы отчета отправлены! ({period_info})", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
@@ -455,26 +514,127 @@ async def handle_report_format(query, context, sheet_type, dept_number, period,
         elif format_type == "excel":
             await handle_excel_format(query, context, df_stats, "Отчет", period)
         elif format_type == "plot":
-            await handle_plot_format(query, context, df_stats, "Отчет")
+            await handle_plot_format(query, context, df_stats, "Отчет", as_of)
         elif format_type == "table":
-            await handle_table_format(query, context, all_stats, "Отчет")
+            await handle_table_format(query, context, all_stats, "Отчет", as_of)
         elif format_type == "incoming":
             await handle_incoming_numbers_excel(query, context, sheet_type, dept_number, period)
         
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
     except Exception as e:
         logger.error(f"Ошибка при обработке формата отчета: {str(e)}")
         await safe_edit_message(query, f"❌ Произошла ошибка: {str(e)}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
 
-async def handle_table_format(query, context, all_stats, sheet_name):
-    """Обработка табличного формата"""
+# Колонки статистики в отчётах
+STAT_COLUMNS = ['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌', 'Всего звонков']
+# Перцентили длительности разговора (TALK_QUANTILES) и служебная колонка с гистограммой сотрудника
+TALK_COLUMNS = ['Медиана разговора, с', 'P90 разговора, с']
+SKETCH_COLUMN = 'durations'
+
+def format_talk_time(seconds):
+    """Длительность в виде М:СС для таблиц ('—', если разговоров не было)"""
+    if seconds is None or pd.isna(seconds):
+        return '—'
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+def build_employee_stats(employees, summaries):
+    """
+    Строки отчёта по сотрудникам из статистики звонков (сотрудники без звонков пропускаются)
+
+    Args:
+        employees (list): Сотрудники
+        summaries (list): Статистика {'incoming', 'outgoing', 'missed', 'total', 'durations'} в том же порядке (None - нет звонков)
+
+    Returns:
+        list: Строки {'Сотрудник', 'Отдел', STAT_COLUMNS, TALK_COLUMNS, SKETCH_COLUMN}
+    """
+    rows = []
+    for employee, summary in zip(employees, summaries):
+        if not summary or not summary['total']:
+            continue
+        rows.append({
+            'Сотрудник': f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip(),
+            'Отдел': get_department_numbers(employee['department']),
+            'Входящие 📞': summary['incoming'],
+            'Исходящие 📤': summary['outgoing'],
+            'Пропущенные ❌': summary['missed'],
+            'Всего звонков': summary['total'],
+            **dict(zip(TALK_COLUMNS, talk_percentiles(summary.get('durations')))),
+            SKETCH_COLUMN: summary.get('durations')
+        })
+    return rows
+
+def department_totals(df_stats, sort=True, dropna=True):
+    """
+    Суммы статистики по отделам одним groupby
+
+    Args:
+        df_stats (DataFrame): Строки build_employee_stats
+        sort (bool): Сортировать отделы; иначе порядок первого появления
+        dropna (bool): Пропускать сотрудников без номера отдела
+
+    Returns:
+        DataFrame: Колонки 'Отдел', 'Сотрудников', STAT_COLUMNS, TALK_COLUMNS и SKETCH_COLUMN
+    """
+    grouped = df_stats.groupby('Отдел', sort=sort, dropna=dropna)
+    totals = grouped[STAT_COLUMNS].sum()
+    totals.insert(0, 'Сотрудников', grouped.size())
+    # Перцентили отдела - по слитым гистограммам сотрудников, а не по их перцентилям
+    totals[SKETCH_COLUMN] = grouped[SKETCH_COLUMN].agg(merge_sketches)
+    percentiles = [talk_percentiles(sketch) for sketch in totals[SKETCH_COLUMN]]
+    for position, column in enumerate(TALK_COLUMNS):
+        totals[column] = [values[position] for values in percentiles]
+    return totals.reset_index()
+
+def build_excel_summary(df_stats, report_type):
+    """
+    Таблица Excel-отчёта из статистики сотрудников за один groupby по отделам
+
+    Args:
+        df_stats (DataFrame): Строки build_employee_stats
+        report_type (str): "all" - строки отделов со средним на сотрудника, иначе строки сотрудников с итогами отделов
+
+    Returns:
+        DataFrame: Таблица для send_excel, итоговые строки в конце
+    """
+    counts = ['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']
+    departments = department_totals(df_stats, sort=False, dropna=False)
+    total = df_stats[counts].sum()
+    total_talk = dict(zip(TALK_COLUMNS, talk_percentiles(merge_sketches(df_stats[SKETCH_COLUMN]))))
+
+    if report_type == "all":
+        # Сумма по отделу и среднее на сотрудника в скобках
+        per_head = departments[counts].div(departments['Сотрудников'], axis=0).round(1)
+        rows = pd.DataFrame({'Отдел': departments['Отдел']})
+        for column in counts:
+            rows[column] = [f"{value} ({average})" for value, average in zip(departments[column], per_head[column])]
+        rows[TALK_COLUMNS] = departments[TALK_COLUMNS]
+        totals = pd.DataFrame([{'Отдел': 'ИТОГО ВСЕГО', **total.to_dict(), **total_talk}])
+        return pd.concat([rows, totals], ignore_index=True)
+
+    # Первым столбцом - фамилия и имя сотрудника
+    column_order = ['Сотрудник', 'Отдел'] + STAT_COLUMNS + TALK_COLUMNS
+    dept_totals = departments[['Отдел'] + counts].copy()
+    dept_totals.insert(0, 'Сотрудник', [f'ИТОГО {dept}' for dept in departments['Отдел']])
+    dept_totals['Всего звонков'] = dept_totals[counts].sum(axis=1)
+    dept_totals[TALK_COLUMNS] = departments[TALK_COLUMNS]
+    grand_total = pd.DataFrame([{
+        'Сотрудник': 'ИТОГО ВСЕГО', 'Отдел': '', **total.to_dict(), 'Всего звонков': total.sum(), **total_talk
+    }])
+    return pd.concat([df_stats[column_order], dept_totals, grand_total], ignore_index=True)
+
+async def handle_table_format(query, context, all_stats, sheet_name, as_of=None):
+    """Обработка табличного формата (as_of - время актуальности данных HH:MM:SS)"""
     try:
         # Показываем прогресс
         await safe_edit_message(query, "🔄 Формирую таблицу...", reply_markup=None)
         
         # Создаем таблицу
         table = PrettyTable()
-        table.field_names = ["Сотрудник", "Отдел", "Входящие", "Исходящие", "Пропущенные", "Всего"]
+        table.field_names = ["Сотрудник", "Отдел", "Входящие", "Исходящие", "Пропущенные", "Всего", "Медиана", "P90"]
         
         for stats in all_stats:
             table.add_row([
@@ -483,11 +643,13 @@ async def handle_table_format(query, context, all_stats, sheet_name):
                 stats['Входящие 📞'],
                 stats['Исходящие 📤'],
                 stats['Пропущенные ❌'],
-                stats['Всего звонков']
+                stats['Всего звонков'],
+                *(format_talk_time(stats[column]) for column in TALK_COLUMNS)
             ])
         
         # Отправляем таблицу
-        await safe_edit_message(query, f"📋 Таблица отчета:\n\n`{table}`", parse_mode=ParseMode.MARKDOWN,
+        title = f"📋 Таблица отчета (данные на {as_of})" if as_of else "📋 Таблица отчета"
+        await safe_edit_message(query, f"{title}:\n\n`{table}`", parse_mode=ParseMode.MARKDOWN,
                                               reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
                 )
     except Exception as e:
@@ -496,8 +658,8 @@ async def handle_table_format(query, context, all_stats, sheet_name):
                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
 
-async def handle_plot_format(query, context, df_stats, sheet_name):
-    """Обработка графического формата"""
+async def handle_plot_format(query, context, df_stats, sheet_name, as_of=None):
+    """Обработка графического формата (as_of - время актуальности данных HH:MM:SS)"""
     try:
         # Показываем прогресс
         await safe_edit_message(query, "🔄 Создаю график...", reply_markup=None)
@@ -506,12 +668,8 @@ async def handle_plot_format(query, context, df_stats, sheet_name):
         fig, ax = plt.subplots(figsize=(12, 8))
         
         # Группируем данные по отделам
-        dept_stats = df_stats.groupby('Отдел').agg({
-            'Входящие 📞': 'sum',
-            'Исходящие 📤': 'sum',
-            'Пропущенные ❌': 'sum'
-    }).reset_index()
-    
+        dept_stats = department_totals(df_stats)
+
         # Создаем столбчатую диаграмму
         x = range(len(dept_stats))
         width = 0.25
@@ -522,7 +680,7 @@ async def handle_plot_format(query, context, df_stats, sheet_name):
         
         ax.set_xlabel('Отделы')
         ax.set_ylabel('Количество звонков')
-        ax.set_title(f'Статистика звонков по отделам')
+        ax.set_title(f'Статистика звонков по отделам (данные на {as_of})' if as_of else 'Статистика звонков по отделам')
         ax.set_xticks(x)
         ax.set_xticklabels(dept_stats['Отдел'])
         ax.legend()
@@ -538,6 +696,112 @@ async def handle_plot_format(query, context, df_stats, sheet_name):
                                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
 
+# Кэш картинок тепловой карты за закрытые периоды: (отдел, начало, конец, номера сотрудников) -> PNG
+HEATMAP_CACHE_SIZE = 32
+_heatmap_cache = OrderedDict()
+WEEKDAY_NAMES = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
+def render_heatmap(counts, title):
+    """
+    Картинка тепловой карты звонков
+
+    Args:
+        counts (numpy.ndarray): Матрица 7 x 24 из hour_weekday_counts
+        title (str): Заголовок
+
+    Returns:
+        bytes: PNG
+    """
+    # Figure без pyplot: отрисовка выполняется в потоке пула
+    from matplotlib.figure import Figure
+    
+    fig = Figure(figsize=(14, 5))
+    ax = fig.subplots()
+    image = ax.imshow(counts, cmap='YlOrRd', aspect='auto')
+    ax.set_xticks(range(24))
+    ax.set_xticklabels([f"{hour:02d}" for hour in range(24)])
+    ax.set_yticks(range(7))
+    ax.set_yticklabels(WEEKDAY_NAMES)
+    ax.set_xlabel('Час начала звонка')
+    ax.set_ylabel('День недели')
+    ax.set_title(title)
+    # Подписи в ячейках: светлый текст на тёмных ячейках
+    threshold = counts.max() / 2
+    for weekday, hour in zip(*counts.nonzero()):
+        value = counts[weekday, hour]
+        ax.text(hour, weekday, value, ha='center', va='center', fontsize=7,
+                color='white' if value > threshold else 'black')
+    fig.colorbar(image, ax=ax, label='Количество звонков')
+    
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=150, bbox_inches='tight')
+    return buffer.getvalue()
+
+async def handle_heatmap_format(query, context, dept_number, period):
+    """
+    Обработка формата "Тепловая карта" - звонки по часам и дням недели
+
+    Счётчики считаются одним bincount по колонкам времени начала CallRecords; картинка за закрытый
+    период строится один раз и дальше берётся из кэша, поэтому звонки берутся без подстановки
+    тестовых данных: при ошибке API карта не строится.
+    """
+    try:
+        await safe_edit_message(query, "🔄 Строю тепловую карту...", reply_markup=None)
+        
+        loop = asyncio.get_running_loop()
+        employees = await loop.run_in_executor(None, employee_provider.get_employees)
+        if dept_number != "all":
+            employees = [employee for employee in employees if get_department_numbers(employee['department']) == dept_number]
+        employees = [employee for employee in employees if employee.get('sim') and employee['sim'] != 'Нет данных']
+        if not employees:
+            await safe_edit_message(query, "❌ Нет данных сотрудников", 
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+            )
+            return
+        
+        start_date_str, end_date_str = get_period_dates(period, context)
+        period_info = get_period_dates_info(period, context)
+        # Период закрыт, если не включает сегодняшний день: звонки за него больше не меняются
+        closed = end_date_str < get_actual_now().strftime("%Y-%m-%d")
+        key = (dept_number, start_date_str, end_date_str, tuple(sorted(employee['sim'] for employee in employees)))
+        
+        image = _heatmap_cache.get(key) if closed else None
+        if image is not None:
+            _heatmap_cache.move_to_end(key)
+            logger.info(f"Тепловая карта за {start_date_str} - {end_date_str} взята из кэша")
+        else:
+            histories = await fetch_call_histories(
+                employees, start_date_str, end_date_str,
+                on_progress=make_fetch_progress(query, "🔄 Строю тепловую карту..."),
+                fetch=fetch_call_records_strict
+            )
+            counts = hour_weekday_counts(histories)
+            if not counts.any():
+                await safe_edit_message(query, "❌ Нет звонков за указанный период", 
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+                )
+                return
+            scope = "все отделы" if dept_number == "all" else f"отдел {dept_number}"
+            title = f"Звонки по часам и дням недели: {scope} ({period_info})"
+            image = await loop.run_in_executor(None, render_heatmap, counts, title)
+            if closed:
+                _heatmap_cache[key] = image
+                while len(_heatmap_cache) > HEATMAP_CACHE_SIZE:
+                    _heatmap_cache.popitem(last=False)
+        
+        await context.bot.send_photo(chat_id=query.message.chat_id, photo=image)
+        await safe_edit_message(query, "🗓 Тепловая карта отправлена!", 
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+        )
+        
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
+    except Exception as e:
+        logger.error(f"Ошибка при создании тепловой карты: {str(e)}")
+        await safe_edit_message(query, f"❌ Ошибка при создании тепловой карты: {str(e)}", 
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+        )
+
 async def handle_excel_format(query, context, df_stats, sheet_name, period):
     logger.info("Начало формирования Excel-файла")
     
@@ -577,61 +841,7 @@ async def handle_excel_format(query, context, df_stats, sheet_name, period):
                 return
             df_stats = filtered_df
         
-        if report_type == "all":
-            excel_df = pd.DataFrame()
-            required_columns = ['Отдел', 'Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']
-            for column in required_columns:
-                if column not in df_stats.columns:
-                    df_stats[column] = 0
-            for dept in df_stats['Отдел'].unique():
-                dept_data = df_stats[df_stats['Отдел'] == dept]
-                dept_total = dept_data[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
-                num_employees = len(dept_data) if len(dept_data) else 1
-                excel_df = pd.concat([excel_df, pd.DataFrame([{
-                    'Отдел': dept,
-                    'Входящие 📞': f"{dept_total['Входящие 📞']} ({round(dept_total['Входящие 📞']/num_employees, 1)})",
-                    'Исходящие 📤': f"{dept_total['Исходящие 📤']} ({round(dept_total['Исходящие 📤']/num_employees, 1)})",
-                    'Пропущенные ❌': f"{dept_total['Пропущенные ❌']} ({round(dept_total['Пропущенные ❌']/num_employees, 1)})"
-                }])], ignore_index=True)
-            total = df_stats[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
-            excel_df = pd.concat([excel_df, pd.DataFrame([{
-                'Отдел': 'ИТОГО ВСЕГО',
-                'Входящие 📞': total['Входящие 📞'],
-                'Исходящие 📤': total['Исходящие 📤'],
-                'Пропущенные ❌': total['Пропущенные ❌']
-            }])], ignore_index=True)
-        else:
-            excel_df = df_stats.copy()
-            # Переупорядочиваем колонки для отчета по отделам
-            # Первым столбцом должна быть фамилия и имя сотрудника
-            column_order = ['Сотрудник', 'Отдел', 'Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌', 'Всего звонков']
-            # Добавляем колонки, которых может не быть
-            for col in column_order:
-                if col not in excel_df.columns:
-                    excel_df[col] = 0
-            # Переупорядочиваем колонки
-            excel_df = excel_df[column_order]
-            
-            for dept in df_stats['Отдел'].unique():
-                dept_data = df_stats[df_stats['Отдел'] == dept]
-                dept_total = dept_data[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
-                excel_df = pd.concat([excel_df, pd.DataFrame([{
-                    'Сотрудник': f'ИТОГО {dept}',
-                    'Отдел': dept,
-                    'Входящие 📞': dept_total['Входящие 📞'],
-                    'Исходящие 📤': dept_total['Исходящие 📤'],
-                    'Пропущенные ❌': dept_total['Пропущенные ❌'],
-                    'Всего звонков': dept_total['Входящие 📞'] + dept_total['Исходящие 📤'] + dept_total['Пропущенные ❌']
-                }])], ignore_index=True)
-            total = df_stats[['Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌']].sum()
-            excel_df = pd.concat([excel_df, pd.DataFrame([{
-                'Сотрудник': 'ИТОГО ВСЕГО',
-                'Отдел': '',
-                'Входящие 📞': total['Входящие 📞'],
-                'Исходящие 📤': total['Исходящие 📤'],
-                'Пропущенные ❌': total['Пропущенные ❌'],
-                'Всего звонков': total['Входящие 📞'] + total['Исходящие 📤'] + total['Пропущенные ❌']
-            }])], ignore_index=True)
+        excel_df = build_excel_summary(df_stats, report_type)
         
         # Добавляем информацию о периоде в имя файла
         filename = f"calls_stats_{sheet_name.lower()}_{period_info.replace(':', '').replace(' ', '_').replace('/', '_')}.xlsx"
@@ -842,52 +1052,16 @@ async def handle_report_format_quarter(query, context, sheet_type, dept_number,
             logger.info(f"Отфильтровано {len(filtered)} сотрудников для отдела {dept_number}")
 
         # Собираем статистику по сотрудникам
-        all_stats = []
-        total_employees = len(filtered)
-        current_employee = 0
+        filtered = [employee for employee in filtered if employee.get('sim') and employee['sim'] != 'Нет данных']
         
-        for employee in filtered:
-            if not employee.get('sim') or employee['sim'] == 'Нет данных':
-                continue
-                
-            current_employee += 1
-            
-            # Обновляем прогресс-бар
-            progress = (current_employee / total_employees) * 100
-            progress_bar = "█" * int(progress / 2) + "░" * (50 - int(progress / 2))
-            progress_text = (
-                f"🔄 Формирую квартальный отчет...\n"
-                f"Прогресс: {progress_bar} {progress:.1f}%\n"
-                f"Обработано сотрудников: {current_employee}/{total_employees}\n"
-                f"Текущий: {employee.get('last_name', '')} {employee.get('first_name', '')}"
-            )
-            await safe_edit_message(query, progress_text, reply_markup=None)
-            
-            # Получаем данные звонков
-            data = fetch_call_history(start_date_str, end_date_str, employee['sim'])
-            if not data:
-                continue
-            
-            # Подсчитываем статистику
-            df = pd.DataFrame(data)
-            if not df.empty:
-                incoming_types = ['in', 'incoming', 'received', 'inbound', 'входящий']
-                outgoing_types = ['out', 'outgoing', 'исходящий']
-                missed_statuses = ['noanswer', 'missed', 'пропущен', 'неотвечен', 'нет ответа']
-
-                incoming_count = df[df['type'].str.lower().isin(incoming_types)].shape[0]
-                outgoing_count = df[df['type'].str.lower().isin(outgoing_types)].shape[0]
-                missed_count = df[df['status'].str.lower().isin(missed_statuses)].shape[0] if 'status' in df.columns else 0
-                
-                stats_dict = {
-                    'Сотрудник': f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip(),
-                    'Отдел': get_department_numbers(employee['department']),
-                    'Входящие 📞': incoming_count,
-                    'Исходящие 📤': outgoing_count,
-                    'Пропущенные ❌': missed_count,
-                    'Всего звонков': len(data)
-                }
-                all_stats.append(stats_dict)
+        # Получаем данные звонков параллельно
+        summaries = await fetch_call_histories(
+            filtered, start_date_str, end_date_str,
+            on_progress=make_fetch_progress(query, "🔄 Формирую квартальный отчет..."),
+            summarize=True
+        )
+        
+        all_stats = build_employee_stats(filtered, summaries)
 
         if not all_stats:
             logger.error("Нет данных для создания отчета")
@@ -916,6 +1090,8 @@ async def handle_report_format_quarter(query, context, sheet_type, dept_number,
         elif format_type == "incoming":
             await handle_incoming_numbers_excel(query, context, sheet_type, dept_number, period)
         
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
     except Exception as e:
         logger.error(f"Ошибка при обработке квартального отчета: {str(e)}")
         await safe_edit_message(query, f"❌ Произошла ошибка: {str(e)}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
@@ -936,14 +1112,8 @@ async def create_quarter_report_3sheets(query, context, year, quarter, sheet_typ
         
         # Прогресс-бар уже запущен в generate_quarter_report
         
-        # Создаем Excel файл с 3 листами
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, Alignment, PatternFill
-        
-        wb = Workbook()
-        
-        # Удаляем дефолтный лист
-        wb.remove(wb.active)
+        # Создаем Excel файл с 3 листами (потоковая запись)
+        wb = StreamingWorkbook()
         
         # Получаем сотрудников
         employees = employee_provider.get_employees()
@@ -962,160 +1132,66 @@ async def create_quarter_report_3sheets(query, context, year, quarter, sheet_typ
                     filtered_employees.append(employee)
             employees = filtered_employees
         
-        # Создаем листы для каждого месяца
-        total_months = len(months)
-        current_month = 0
+        # Получаем звонки за весь квартал одним запросом на сотрудника и раскладываем по месяцам локально
+        employees = [employee for employee in employees if employee.get('sim') and employee['sim'] != 'Нет данных']
+        start_date_str, end_date_str = get_period_dates(period, context)
+        logger.info(f"Получаем данные за {quarter} квартал {year}: {start_date_str} - {end_date_str}")
+        monthly_summaries = await fetch_call_histories(
+            employees, start_date_str, end_date_str,
+            on_progress=make_fetch_progress(query, f"🔄 Формирую квартальный отчет {year} Q{quarter}..."),
+            fetch=fetch_call_summary_by_month
+        )
         
+        # Создаем листы для каждого месяца
         for month_name, month_num in months:
-            current_month += 1
-            
-            # Обновляем прогресс-бар для месяцев
-            month_progress = (current_month / total_months) * 100
-            month_progress_bar = "█" * int(month_progress / 2) + "░" * (50 - int(month_progress / 2))
-            month_progress_text = (
-                f"🔄 Формирую квартальный отчет...\n"
-                f"Месяц: {month_name} {year}\n"
-                f"Прогресс месяцев: {month_progress_bar} {month_progress:.1f}%\n"
-                f"Обработано месяцев: {current_month}/{total_months}"
-            )
-            await safe_edit_message(query, month_progress_text, reply_markup=None)
-            
-            ws = wb.create_sheet(title=month_name)
+            headers = ['Сотрудник', 'Отдел'] + STAT_COLUMNS + TALK_COLUMNS
+            widths = ColumnWidths(headers)
+            month_key = f"{year}-{month_num:02d}"
             
-            # Заголовки
-            headers = ['Сотрудник', 'Отдел', 'Входящие 📞', 'Исходящие 📤', 'Пропущенные ❌', 'Всего звонков']
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col, value=header)
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal='center')
-                cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+            # Собираем строки по сотрудникам; ширины колонок - по максимумам по мере сборки
+            month_stats = build_employee_stats(employees, [by_month.get(month_key) for by_month in monthly_summaries])
+            rows = [
+                widths.update([stats['Сотрудник'], stats['Отдел']] + [stats[name] for name in STAT_COLUMNS + TALK_COLUMNS])
+                for stats in month_stats
+            ]
+            total_incoming = sum(stats['Входящие 📞'] for stats in month_stats)
+            total_outgoing = sum(stats['Исходящие 📤'] for stats in month_stats)
+            total_missed = sum(stats['Пропущенные ❌'] for stats in month_stats)
             
-            # Создаем период для месяца
-            month_period = f"month_{year}_{month_num:02d}"
+            # Итоговая строка, если есть данные
+            total_row = None
+            if rows:
+                month_talk = talk_percentiles(merge_sketches(stats[SKETCH_COLUMN] for stats in month_stats))
+                total_row = widths.update([
+                    f"ИТОГО {dept_number if dept_number != 'all' else 'ВСЕГО'}", "",
+                    total_incoming, total_outgoing, total_missed,
+                    total_incoming + total_outgoing + total_missed, *month_talk
+                ])
             
-            # Получаем данные за месяц
-            try:
-                start_date_str, end_date_str = get_period_dates(month_period, context)
-                logger.info(f"Получаем данные за {month_name} {year}: {start_date_str} - {end_date_str}")
-                
-                # Собираем статистику по сотрудникам
-                row = 2
-                total_incoming = 0
-                total_outgoing = 0
-                total_missed = 0
-                
-                # Прогресс-бар для сотрудников в текущем месяце
-                valid_employees = [emp for emp in employees if emp.get('sim') and emp['sim'] != 'Нет данных']
-                total_employees = len(valid_employees)
-                current_employee = 0
-                
-                for employee in employees:
-                    if not employee.get('sim') or employee['sim'] == 'Нет данных':
-                        continue
-                    
-                    current_employee += 1
-                    
-                    # Обновляем прогресс-бар для сотрудников
-                    employee_progress = (current_employee / total_employees) * 100
-                    employee_progress_bar = "█" * int(employee_progress / 2) + "░" * (50 - int(employee_progress / 2))
-                    employee_progress_text = (
-                        f"🔄 Формирую квартальный отчет...\n"
-                        f"Месяц: {month_name} {year}\n"
-                        f"Прогресс месяцев: {month_progress_bar} {month_progress:.1f}%\n"
-                        f"Обработано месяцев: {current_month}/{total_months}\n"
-                        f"Сотрудник: {employee['last_name']} {employee['first_name']}\n"
-                        f"Прогресс сотрудников: {employee_progress_bar} {employee_progress:.1f}%\n"
-                        f"Обработано сотрудников: {current_employee}/{total_employees}"
-                    )
-                    await safe_edit_message(query, employee_progress_text, reply_markup=None)
-                    
-                    # Небольшая задержка для избежания слишком частых обновлений
-                    await asyncio.sleep(0.1)
-                        
-                    # Получаем данные звонков за месяц
-                    data = fetch_call_history(start_date_str, end_date_str, employee['sim'])
-                    if not data:
-                        continue
-                    
-                    # Подсчитываем статистику
-                    df = pd.DataFrame(data)
-                    if not df.empty:
-                        incoming_types = ['in', 'incoming', 'received', 'inbound', 'входящий']
-                        outgoing_types = ['out', 'outgoing', 'исходящий']
-                        missed_statuses = ['noanswer', 'missed', 'пропущен', 'неотвечен', 'нет ответа']
-
-                        incoming_count = df[df['type'].str.lower().isin(incoming_types)].shape[0]
-                        outgoing_count = df[df['type'].str.lower().isin(outgoing_types)].shape[0]
-                        missed_count = df[df['status'].str.lower().isin(missed_statuses)].shape[0] if 'status' in df.columns else 0
-                        total_calls = len(data)
-                        
-                        # Добавляем данные в лист
-                        ws.cell(row=row, column=1, value=f"{employee['last_name']} {employee['first_name']}")
-                        ws.cell(row=row, column=2, value=get_department_numbers(employee['department']))
-                        ws.cell(row=row, column=3, value=incoming_count)
-                        ws.cell(row=row, column=4, value=outgoing_count)
-                        ws.cell(row=row, column=5, value=missed_count)
-                        ws.cell(row=row, column=6, value=total_calls)
-                        
-                        total_incoming += incoming_count
-                        total_outgoing += outgoing_count
-                        total_missed += missed_count
-                        row += 1
-                
-                # Добавляем итоговую строку
-                if row > 2:  # Если есть данные
-                    ws.cell(row=row, column=1, value=f"ИТОГО {dept_number if dept_number != 'all' else 'ВСЕГО'}")
-                    ws.cell(row=row, column=2, value="")
-                    ws.cell(row=row, column=3, value=total_incoming)
-                    ws.cell(row=row, column=4, value=total_outgoing)
-                    ws.cell(row=row, column=5, value=total_missed)
-                    ws.cell(row=row, column=6, value=total_incoming + total_outgoing + total_missed)
-                    
-                    # Стили для итоговой строки
-                    for col in range(1, 7):
-                        cell = ws.cell(row=row, column=col)
-                        cell.font = Font(bold=True)
-                        cell.fill = PatternFill(start_color="E6E6E6", end_color="E6E6E6", fill_type="solid")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при получении данных за {month_name}: {str(e)}")
-                ws.cell(row=2, column=1, value=f"Ошибка получения данных: {str(e)}")
-            
-            # Автоподбор ширины столбцов
-            for column in ws.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                ws.column_dimensions[column_letter].width = adjusted_width
+            ws = wb.add_sheet(month_name, headers, widths.widths(), GREY_HEADER)
+            for values in rows:
+                ws.append(values)
+            if total_row is not None:
+                ws.append(wb.styled(ws, total_row, TOTAL_ROW))
         
         # Сохраняем файл
         filename = f"quarter_report_{year}_Q{quarter}_3sheets_{dept_number if dept_number != 'all' else 'all'}.xlsx"
-        filepath = f"/tmp/{filename}"
-        wb.save(filepath)
-        
-        # Отправляем файл
-        with open(filepath, 'rb') as file:
-            await context.bot.send_document(
-                chat_id=query.message.chat_id,
-                document=file,
-                filename=filename,
+        with report_buffer() as buffer:
+            wb.save(buffer)
+            
+            # Отправляем файл
+            await send_document_buffer(
+                buffer, filename, query.message.chat_id, context,
                 caption=f"📊 Квартальный отчет {year} Q{quarter} (3 листа по месяцам)"
             )
         
-        # Удаляем временный файл
-        os.remove(filepath)
-        
         await safe_edit_message(query,
             f"✅ Квартальный отчет {year} Q{quarter} с 3 листами отправлен!",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
         
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
     except Exception as e:
         logger.error(f"Ошибка при создании отчета с 3 листами: {str(e)}")
         await safe_edit_message(query, 
@@ -1139,77 +1215,405 @@ async def update_employees_command(update, context):
 
 # ===== ДОБАВЛЯЮ ОТСУТСТВУЮЩИЕ ФУНКЦИИ =====
 
-def fetch_call_history(start_date, end_date, phone_number):
+def _call_sort_key(call):
+    return str(call.get('start') or call.get('date') or '')
+
+def _iter_calls_api(start_date, end_date, phone_number):
     """
-    Получение истории звонков через API ВАТС
-    
+    Звонки напрямую из API; длинный период делится на части по SPLIT_RANGE_DAYS дней,
+    которые загружаются параллельно и сливаются в порядке времени без дублей на границах
+    """
+    parts = split_day_range(start_date, end_date, SPLIT_RANGE_DAYS) if SPLIT_RANGE_DAYS > 0 else []
+    if len(parts) <= 1:
+        # Запрос через общий клиент с пулом соединений, таймаутами и ретраями
+        yield from vats_client.iter_calls(start_date, end_date, phone_number)
+        return
+
+    started = time.monotonic()
+    futures = [
+        _split_executor.submit(vats_client.get_calls, part_start, part_end, phone_number)
+        for part_start, part_end in parts
+    ]
+    part_calls = [sorted(future.result(), key=_call_sort_key) for future in futures]
+    logger.info(
+        f"Период {start_date} - {end_date} для {phone_number} загружен частями "
+        f"({len(parts)} по {SPLIT_RANGE_DAYS} дн.) за {time.monotonic() - started:.2f} с"
+    )
+    seen_ids = set()
+    for call in heapq.merge(*part_calls, key=_call_sort_key):
+        call_id = call.get('id')
+        if call_id is not None:
+            if call_id in seen_ids:
+                continue
+            seen_ids.add(call_id)
+        yield call
+
+def _iter_calls_source(start_date, end_date, phone_number):
+    """
+    Звонки из локального хранилища (с догрузкой недостающих дней) или напрямую из API
+    """
+    if call_store is not None:
+        # Догружаем только недостающие дни, остальное читаем из локального хранилища
+        call_store.sync(phone_number, start_date, end_date, _iter_calls_api)
+        return call_store.iter_calls(phone_number, start_date, end_date)
+    return _iter_calls_api(start_date, end_date, phone_number)
+
+def _iter_calls_cached(start_date, end_date, phone_number):
+    """
+    Звонки через кэш в памяти: из источника загружаются только дни, которых нет в кэше
+    """
+    days = list(iter_days(start_date, end_date))
+    calls_by_day = {day: call_cache.get(phone_number, day) for day in days}
+    missing = [day for day in days if calls_by_day[day] is None]
+    for run_start, run_end in group_day_runs(missing):
+        run_calls = {day: [] for day in iter_days(run_start, run_end)}
+        moved = 0
+        for call in _iter_calls_source(run_start, run_end, phone_number):
+            day, exact = run_day(call, run_start, run_end)
+            moved += not exact
+            run_calls[day].append(call)
+        if moved:
+            logger.warning(
+                f"Звонков {phone_number} за {run_start} - {run_end} без дня начала в диапазоне: {moved}, "
+                f"отнесены к ближайшему дню диапазона"
+            )
+        for day, calls in run_calls.items():
+            call_cache.put(phone_number, day, calls)
+        calls_by_day.update(run_calls)
+    for day in days:
+        yield from calls_by_day[day]
+
+def _iter_calls_strict(start_date, end_date, phone_number):
+    # Звонки через кэш/хранилище или напрямую из API; ошибки не подменяются тестовыми данными
+    if call_cache is not None:
+        return _iter_calls_cached(start_date, end_date, phone_number)
+    return _iter_calls_source(start_date, end_date, phone_number)
+
+def iter_call_history(start_date, end_date, phone_number):
+    """
+    Потоковое получение истории звонков через API ВАТС
+
+    Звонки запрашиваются постранично и отдаются по одному, без ограничения в 1000 записей.
+    Дни, уже лежащие в кэше в памяти или в локальном хранилище, у API не запрашиваются.
+    Если API недоступно до получения первой страницы, отдаются тестовые данные.
+
     Args:
         start_date (str): Дата начала в формате YYYY-MM-DD
         end_date (str): Дата окончания в формате YYYY-MM-DD
         phone_number (str): Номер телефона сотрудника
-    
-    Returns:
-        list: Список звонков или пустой список при ошибке
+
+    Yields:
+        dict: Звонок
     """
+    logger.info(f"Запрос истории звонков для {phone_number}: {start_date} - {end_date}")
+    received = 0
     try:
-        # Формируем URL для запроса истории звонков
-        url = f"{API_URL}/calls"
-        
-        # Параметры запроса
-        params = {
-            'api_key': API_KEY,
-            'start_date': start_date,
-            'end_date': end_date,
-            'phone': phone_number,
-            'limit': 1000  # Максимальное количество записей
-        }
-        
-        logger.info(f"Запрос истории звонков для {phone_number}: {start_date} - {end_date}")
-        logger.debug(f"URL: {url}")
-        logger.debug(f"API_KEY: {API_KEY[:10]}...")
-        
-        # Выполняем запрос с таймаутом
-        response = requests.get(url, params=params, timeout=30)
-        
-        logger.debug(f"Response status: {response.status_code}")
-        logger.debug(f"Response headers: {dict(response.headers)}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Обрабатываем различные форматы ответа
-            if isinstance(data, dict):
-                if 'result' in data:
-                    calls = data['result']
-                elif 'data' in data:
-                    calls = data['data']
-                elif 'calls' in data:
-                    calls = data['calls']
-                else:
-                    calls = data
-            elif isinstance(data, list):
-                calls = data
-            else:
-                calls = []
-            
-            logger.info(f"Получено {len(calls)} звонков для {phone_number}")
-            return calls if isinstance(calls, list) else []
-            
-        else:
-            logger.error(f"Ошибка API {response.status_code}: {response.text}")
-            # Возвращаем тестовые данные для демонстрации
-            logger.warning(f"Возвращаем тестовые данные для {phone_number}")
-            return generate_test_calls(phone_number, start_date, end_date)
-            
-    except requests.exceptions.Timeout:
+        for call in _iter_calls_strict(start_date, end_date, phone_number):
+            received += 1
+            yield call
+        logger.info(f"Получено {received} звонков для {phone_number}")
+        return
+    except VatsUnavailableError:
+        # API недоступно - отчёт целиком прерывается, тестовые данные не подставляются
+        raise
+    except requests.exceptions.HTTPError as e:
+        error = e
+        logger.error(str(e))
+    except requests.exceptions.Timeout as e:
+        error = e
         logger.error(f"Таймаут при запросе истории звонков для {phone_number}")
-        return generate_test_calls(phone_number, start_date, end_date)
     except requests.exceptions.RequestException as e:
+        error = e
         logger.error(f"Ошибка запроса истории звонков для {phone_number}: {e}")
-        return generate_test_calls(phone_number, start_date, end_date)
     except Exception as e:
+        error = e
         logger.error(f"Неожиданная ошибка при получении истории звонков для {phone_number}: {e}")
-        return generate_test_calls(phone_number, start_date, end_date)
+
+    if received:
+        # Часть страниц уже отдана - смешивать реальные и тестовые данные нельзя
+        raise RuntimeError(f"История звонков для {phone_number} получена не полностью ({received} звонков): {error}")
+
+    # Возвращаем тестовые данные для демонстрации
+    logger.warning(f"Возвращаем тестовые данные для {phone_number}")
+    yield from generate_test_calls(phone_number, start_date, end_date)
+
+def fetch_call_history(start_date, end_date, phone_number):
+    """
+    Получение истории звонков через API ВАТС
+
+    Args:
+        start_date (str): Дата начала в формате YYYY-MM-DD
+        end_date (str): Дата окончания в формате YYYY-MM-DD
+        phone_number (str): Номер телефона сотрудника
+
+    Одинаковые одновременные запросы (например, два менеджера строят один отчёт)
+    выполняются один раз, результат общий - изменять его нельзя.
+
+    Returns:
+        list: Список звонков (тестовые данные при недоступности API)
+    """
+    return _call_flight.do(
+        ('history', phone_number, start_date, end_date),
+        lambda: list(iter_call_history(start_date, end_date, phone_number))
+    )
+
+def _summary_from_rollup(start_date, end_date, phone_number, by_month):
+    """
+    Статистика из дневной сводки хранилища: закрытые дни догружаются и суммируются из daily_stats,
+    текущий день считается по звонкам (через кэш в памяти)
+    """
+    today = get_actual_now().strftime("%Y-%m-%d")
+    closed_end = min(end_date, (get_actual_now() - timedelta(days=1)).strftime("%Y-%m-%d"))
+    if start_date <= closed_end:
+        call_store.sync(phone_number, start_date, closed_end, _iter_calls_api)
+        if by_month:
+            result = call_store.summary_by_month(phone_number, start_date, closed_end)
+        else:
+            result = call_store.summary(phone_number, start_date, closed_end)
+    else:
+        result = {} if by_month else empty_summary()
+
+    if end_date >= today:
+        open_start = max(start_date, today)
+        calls = iter_call_history(open_start, end_date, phone_number)
+        if by_month:
+            for month, summary in summarize_calls_by(calls, lambda call: call_day(call, open_start)[:7]).items():
+                merge_summary(result.setdefault(month, empty_summary()), summary)
+        else:
+            merge_summary(result, summarize_calls(calls))
+    return result
+
+def _call_summary(start_date, end_date, phone_number, by_month=False):
+    if call_store is not None:
+        try:
+            return _summary_from_rollup(start_date, end_date, phone_number, by_month)
+        except VatsUnavailableError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка сводки по дням для {phone_number}, считаем по звонкам: {e}")
+    calls = iter_call_history(start_date, end_date, phone_number)
+    if by_month:
+        return summarize_calls_by(calls, lambda call: call_day(call, start_date)[:7])
+    return summarize_calls(calls)
+
+def fetch_call_summary(start_date, end_date, phone_number):
+    """
+    Подсчёт статистики звонков сотрудника без хранения полного списка звонков
+
+    При включённом хранилище закрытые дни берутся из дневной сводки (daily_stats),
+    по звонкам считается только текущий день.
+
+    Returns:
+        dict: {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds'}
+    """
+    return _call_flight.do(
+        ('summary', phone_number, start_date, end_date),
+        _call_summary, start_date, end_date, phone_number
+    )
+
+def fetch_call_summary_by_month(start_date, end_date, phone_number):
+    """
+    Статистика звонков сотрудника за период с разбивкой по месяцам по полю start
+
+    Returns:
+        dict: {'YYYY-MM': {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds'}}
+    """
+    return _call_flight.do(
+        ('summary_by_month', phone_number, start_date, end_date),
+        _call_summary, start_date, end_date, phone_number, True
+    )
+
+def fetch_call_records(start_date, end_date, phone_number):
+    """
+    История звонков сотрудника в компактном колоночном виде (CallRecords)
+
+    Звонки переводятся в колонки по мере получения страниц, список словарей не собирается.
+
+    Returns:
+        CallRecords: Звонки за период
+    """
+    return _call_flight.do(
+        ('records', phone_number, start_date, end_date),
+        lambda: CallRecords.from_calls(iter_call_history(start_date, end_date, phone_number))
+    )
+
+def fetch_call_records_strict(start_date, end_date, phone_number):
+    """
+    CallRecords только из реальных звонков: при ошибке API исключение, тестовые данные не подставляются
+
+    Для отчётов, которые кэшируются (тепловая карта закрытого периода).
+
+    Returns:
+        CallRecords: Звонки за период
+    """
+    return _call_flight.do(
+        ('records_strict', phone_number, start_date, end_date),
+        lambda: CallRecords.from_calls(_iter_calls_strict(start_date, end_date, phone_number))
+    )
+
+def fetch_caller_counter(start_date, end_date, phone_number):
+    """
+    Счётчик HyperLogLog различных входящих номеров сотрудника из дневных регистров хранилища
+
+    Недостающие дни догружаются в хранилище, текущий день перезагружается.
+
+    Returns:
+        HyperLogLog: Счётчик за период (общий для одинаковых запросов - изменять нельзя)
+    """
+    def count():
+        call_store.sync(phone_number, start_date, end_date, _iter_calls_api)
+        return call_store.unique_callers([phone_number], start_date, end_date)
+
+    return _call_flight.do(('callers', phone_number, start_date, end_date), count)
+
+async def fetch_call_history_async(start_date, end_date, phone_number, fetch=None):
+    """
+    Асинхронная обёртка над fetch_call_history (или другой функцией fetch), не блокирующая цикл событий
+
+    Если такой же запрос уже выполняется, ожидается его результат без занятия потока пула.
+    """
+    fetch = fetch or fetch_call_history
+    key = (fetch.__name__, phone_number, start_date, end_date)
+    future = _inflight_fetches.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_fetch_executor, fetch, start_date, end_date, phone_number)
+        _inflight_fetches[key] = future
+        future.add_done_callback(lambda _: _inflight_fetches.pop(key, None))
+    else:
+        _call_flight.note_shared()
+    return await asyncio.shield(future)
+
+def fetch_calls_bulk(start_date, end_date, employees, summarize=False):
+    """
+    Получение звонков всех сотрудников одним постраничным запросом без фильтра по номеру
+
+    Звонки раскладываются по сотрудникам локально через индекс номеров, поэтому вместо
+    запроса на каждую SIM выполняется несколько запросов на весь период.
+
+    Args:
+        start_date (str): Дата начала в формате YYYY-MM-DD
+        end_date (str): Дата окончания в формате YYYY-MM-DD
+        employees (list): Сотрудники с заполненным полем 'sim'
+        summarize (bool): Вернуть статистику вместо списков звонков
+
+    Returns:
+        list: Списки звонков (или статистика) в том же порядке, что и employees
+    """
+    phone_index = build_phone_index(employees)
+    if summarize:
+        results = [empty_summary() for _ in employees]
+    else:
+        results = [[] for _ in employees]
+    
+    logger.info(f"Массовый запрос истории звонков для {len(employees)} сотрудников: {start_date} - {end_date}")
+    received = 0
+    for call in vats_client.iter_calls(start_date, end_date, None):
+        received += 1
+        for position in match_call_employees(call, phone_index):
+            if summarize:
+                add_call(results[position], call)
+            else:
+                results[position].append(call)
+    logger.info(f"Получено {received} звонков за период {start_date} - {end_date}")
+    return results
+
+async def fetch_call_histories(employees, start_date, end_date, concurrency=None, on_progress=None, summarize=False, bulk=None, fetch=None):
+    """
+    Параллельное получение истории звонков для списка сотрудников
+
+    Args:
+        employees (list): Сотрудники с заполненным полем 'sim'
+        start_date (str): Дата начала в формате YYYY-MM-DD
+        end_date (str): Дата окончания в формате YYYY-MM-DD
+        concurrency (int): Ограничение числа одновременных запросов (по умолчанию FETCH_CONCURRENCY)
+        on_progress: Корутина on_progress(done, total, employee), вызываемая после каждого сотрудника
+        summarize (bool): Вернуть статистику звонков (fetch_call_summary) вместо списков звонков
+        bulk (bool): Загрузить звонки одним запросом на весь период (по умолчанию BULK_FETCH)
+        fetch: Своя функция fetch(start_date, end_date, phone) для каждого сотрудника (без массовой загрузки)
+
+    Returns:
+        list: Списки звонков (или статистика) в том же порядке, что и employees
+    """
+    if fetch is None:
+        fetch = fetch_call_summary if summarize else fetch_call_history
+    elif bulk is None:
+        bulk = False
+    if BULK_FETCH if bulk is None else bulk:
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            key = ('bulk', start_date, end_date, summarize, tuple(employee['sim'] for employee in employees))
+            results = await loop.run_in_executor(
+                _fetch_executor, _call_flight.do, key, fetch_calls_bulk, start_date, end_date, employees, summarize
+            )
+            logger.info(f"История звонков для {len(employees)} сотрудников получена массово за {time.monotonic() - started:.1f} с")
+            return results
+        except VatsUnavailableError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка массовой загрузки звонков, переходим на запросы по номерам: {e}")
+
+    semaphore = asyncio.Semaphore(concurrency or FETCH_CONCURRENCY)
+    total = len(employees)
+    done = 0
+
+    async def fetch_one(employee):
+        nonlocal done
+        async with semaphore:
+            calls = await fetch_call_history_async(start_date, end_date, employee['sim'], fetch)
+        done += 1
+        if on_progress:
+            await on_progress(done, total, employee)
+        return calls
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(fetch_one(employee) for employee in employees))
+    logger.info(f"История звонков для {total} сотрудников получена за {time.monotonic() - started:.1f} с")
+    if call_cache is not None:
+        cache_stats = call_cache.stats()
+        logger.info(
+            f"Кэш звонков: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"дней {cache_stats['entries']}, {cache_stats['bytes'] / 1024 / 1024:.1f} МБ, "
+            f"объединено одинаковых запросов {_call_flight.shared}"
+        )
+    return results
+
+async def notify_vats_unavailable(query, error):
+    """
+    Сообщение пользователю о недоступности API ВАТС вместо отчёта на тестовых данных
+    """
+    logger.error(f"Отчёт прерван: {error}")
+    await safe_edit_message(query,
+        f"⚠️ API ВАТС сейчас недоступно, отчёт не сформирован.\n{error}\nПопробуйте позже.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+    )
+
+def make_fetch_progress(query, title, min_interval=1.0):
+    """
+    Создаёт колбэк прогресса для fetch_call_histories
+
+    Сообщение обновляется не чаще раза в min_interval секунд, чтобы не упираться в лимиты Telegram.
+    """
+    last_update = 0.0
+
+    async def on_progress(done, total, employee):
+        nonlocal last_update
+        now = time.monotonic()
+        if done < total and now - last_update < min_interval:
+            return
+        last_update = now
+        progress = (done / total) * 100
+        progress_bar = "█" * int(progress / 2) + "░" * (50 - int(progress / 2))
+        progress_text = (
+            f"{title}\n"
+            f"Прогресс: {progress_bar} {progress:.1f}%\n"
+            f"Обработано сотрудников: {done}/{total}\n"
+            f"Текущий: {employee.get('last_name', '')} {employee.get('first_name', '')}"
+        )
+        await safe_edit_message(query, progress_text, reply_markup=None)
+
+    return on_progress
 
 def generate_test_calls(phone_number, start_date, end_date):
     """
@@ -1421,6 +1825,53 @@ def get_period_dates_info(period, context):
         logger.error(f"Ошибка при получении информации о периоде {period}: {e}")
         return f"Период {period}"
 
+def report_buffer():
+    """
+    Буфер для файла отчёта (xlsx, png, csv, zip)
+    
+    Данные хранятся в памяти, а при превышении REPORT_SPOOL_MB переносятся во временный файл
+    с уникальным именем, который удаляется при закрытии буфера.
+    
+    Returns:
+        tempfile.SpooledTemporaryFile: Буфер (использовать через with)
+    """
+    return tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_MB * 1024 * 1024)
+
+def buffer_input(buffer, filename):
+    """
+    Файл для отправки из буфера отчёта
+    
+    У буфера в памяти нет имени (name is None), а PTB берёт имя из файлового объекта и падает,
+    даже если filename передан явно, поэтому отправляется содержимое с явным именем файла.
+    
+    Args:
+        buffer: Буфер (report_buffer или BytesIO)
+        filename (str): Имя файла в чате
+    
+    Returns:
+        InputFile: Файл для send_document/send_photo
+    """
+    buffer.seek(0)
+    return InputFile(buffer.read(), filename=filename)
+
+async def send_document_buffer(buffer, filename, chat_id, context, caption=None):
+    """
+    Отправка файла из буфера в чат
+    
+    Args:
+        buffer: Буфер с содержимым файла (report_buffer или BytesIO)
+        filename (str): Имя файла
+        chat_id (int): ID чата
+        context: Контекст бота
+        caption (str): Подпись
+    """
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=buffer_input(buffer, filename),
+        caption=caption
+    )
+    logger.info(f"Файл {filename} отправлен в чат {chat_id}")
+
 async def send_excel(df, filename, chat_id, context):
     """
     Отправка Excel файла в чат
@@ -1432,45 +1883,118 @@ async def send_excel(df, filename, chat_id, context):
         context: Контекст бота
     """
     try:
-        # Создаем временный файл
-        filepath = f"/tmp/{filename}"
-        
-        # Сохраняем DataFrame в Excel
-        with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Отчет', index=False)
-            
-            # Получаем лист для стилизации
-            worksheet = writer.sheets['Отчет']
-            
-            # Автоподбор ширины столбцов
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-        
-        # Отправляем файл
-        with open(filepath, 'rb') as file:
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=file,
-                filename=filename
-            )
-        
-        # Удаляем временный файл
-        os.remove(filepath)
-        logger.info(f"Excel файл {filename} отправлен в чат {chat_id}")
+        with report_buffer() as buffer:
+            # Сохраняем DataFrame в Excel потоковой записью вне цикла событий
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, write_frame, buffer, df)
+            await send_document_buffer(buffer, filename, chat_id, context)
         
     except Exception as e:
         logger.error(f"Ошибка при отправке Excel файла {filename}: {e}")
         raise
 
+# Колонки отчёта по входящим номерам и значение для пропусков
+INCOMING_COLUMNS = ('Сотрудник', 'Отдел', 'Входящий номер', 'Дата/время', 'Длительность', 'Статус')
+UNKNOWN_VALUE = 'Неизвестно'
+# Столько строк одного сотрудника переводится из колонок в значения Python за раз
+EXPORT_CHUNK_ROWS = 2048
+
+def _export_value(value):
+    return UNKNOWN_VALUE if value is None else value
+
+def _text_width(values):
+    return max((len(str(_export_value(value))) for value in values), default=0)
+
+def iter_incoming_rows(employee, records, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Входящие звонки сотрудника от новых к старым
+    
+    Порядок строится argsort по колонке времени, а строки отчёта создаются порциями по chunk_rows,
+    поэтому в памяти одновременно только индексы входящих звонков и одна порция строк.
+    
+    Args:
+        employee (dict): Сотрудник
+        records (CallRecords): Звонки сотрудника
+        chunk_rows (int): Размер порции
+    
+    Yields:
+        tuple: (ключ сортировки, строка в порядке INCOMING_COLUMNS)
+    """
+    rows = np.flatnonzero(records.incoming())
+    starts = records.start[rows]
+    # Секунды от эпохи; звонки без времени идут первыми, как 'Неизвестно' при прежней сортировке строк по убыванию
+    keys = starts.astype(np.int64)
+    keys[np.isnat(starts)] = np.iinfo(np.int64).max
+    order = np.argsort(-keys, kind='stable')
+    rows, keys = rows[order], keys[order]
+    
+    name = f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip()
+    department = _export_value(get_department_numbers(employee['department']))
+    for offset in range(0, len(rows), chunk_rows):
+        part = rows[offset:offset + chunk_rows]
+        columns = [records.column(column, part) for column in ('from', 'start', 'duration', 'status')]
+        for key, phone, start, duration, status in zip(keys[offset:offset + chunk_rows].tolist(), *columns):
+            yield key, (
+                name, department, _export_value(phone), _export_value(start),
+                _export_value(duration), _export_value(status)
+            )
+
+def incoming_column_widths(employees, histories):
+    """
+    Ширины колонок отчёта по входящим номерам без обхода строк: по словарям номеров и статусов CallRecords
+    
+    Returns:
+        list: Ширины в порядке INCOMING_COLUMNS
+    """
+    widths = [len(column) for column in INCOMING_COLUMNS]
+    for employee, records in zip(employees, histories):
+        incoming = records.incoming()
+        if not incoming.any():
+            continue
+        name = f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip()
+        phones = [records.phones[phone_id] for phone_id in np.unique(records.from_id[incoming])]
+        statuses = [records.statuses[status_id] for status_id in np.unique(records.status_id[incoming])]
+        durations = records.duration[incoming]
+        starts = records.start[incoming]
+        # Время и длительность, не представимые в колонках, выводятся как пришли от API
+        raw_starts = [value for position, value in records.raw_starts.items() if incoming[position]]
+        raw_durations = [value for position, value in records.raw_durations.items() if incoming[position]]
+        values = (
+            [name], [get_department_numbers(employee['department'])], phones,
+            ['0000-00-00 00:00:00'] + raw_starts + ([None] if np.isnat(starts).any() else []),
+            [int(durations.max())] + raw_durations + ([None] if (durations == -1).any() else []),
+            statuses,
+        )
+        widths = [max(width, _text_width(column)) for width, column in zip(widths, values)]
+    return [min(width + 2, 50) for width in widths]
+
+def write_incoming_excel(target, employees, histories):
+    """
+    Потоковая запись отчёта по входящим номерам
+    
+    Отсортированные потоки сотрудников сливаются heapq.merge по времени звонка и сразу пишутся
+    в книгу StreamingWorkbook, поэтому ни общая таблица, ни объекты всех ячеек в памяти не собираются.
+    
+    Args:
+        target: Путь к файлу или файловый объект (report_buffer)
+        employees (list): Сотрудники
+        histories (list): CallRecords в порядке employees
+    
+    Returns:
+        int: Количество записанных звонков
+    """
+    # В режиме write_only ширины задаются до первой строки: считаются по словарям, а не по строкам
+    workbook = StreamingWorkbook()
+    worksheet = workbook.add_sheet('Отчет', INCOMING_COLUMNS, incoming_column_widths(employees, histories))
+    
+    streams = [iter_incoming_rows(employee, records) for employee, records in zip(employees, histories)]
+    written = 0
+    for _, row in heapq.merge(*streams, key=lambda item: item[0], reverse=True):
+        worksheet.append(row)
+        written += 1
+    workbook.save(target)
+    return written
+
 async def send_plot(fig, chat_id, context):
     """
     Отправка графика в чат
@@ -1481,20 +2005,16 @@ async def send_plot(fig, chat_id, context):
         context: Контекст бота
     """
     try:
-        # Сохраняем график во временный файл
-        filepath = "/tmp/plot.png"
-        fig.savefig(filepath, dpi=300, bbox_inches='tight')
-        plt.close(fig)  # Закрываем фигуру для освобождения памяти
-        
-        # Отправляем файл
-        with open(filepath, 'rb') as file:
+        with report_buffer() as buffer:
+            # Рисуем график в буфер: у каждого запроса свой, одновременные графики не пересекаются
+            fig.savefig(buffer, format='png', dpi=300, bbox_inches='tight')
+            plt.close(fig)  # Закрываем фигуру для освобождения памяти
+            
+            # Отправляем файл
             await context.bot.send_photo(
                 chat_id=chat_id,
-                photo=file
+                photo=buffer_input(buffer, "plot.png")
             )
-        
-        # Удаляем временный файл
-        os.remove(filepath)
         logger.info(f"График отправлен в чат {chat_id}")
         
     except Exception as e:
@@ -1554,59 +2074,45 @@ async def handle_incoming_numbers_excel(query, context, sheet_type, dept_number,
         # Получаем даты периода
         start_date_str, end_date_str = get_period_dates(period, context)
         
-        # Собираем входящие номера
-        incoming_numbers = []
+        employees = [employee for employee in employees if employee.get('sim') and employee['sim'] != 'Нет данных']
         
-        for employee in employees:
-            if not employee.get('sim') or employee['sim'] == 'Нет данных':
-                continue
-            
-            # Получаем данные звонков
-            data = fetch_call_history(start_date_str, end_date_str, employee['sim'])
-            if not data:
-                continue
-            
-            # Фильтруем входящие звонки
-            df = pd.DataFrame(data)
-            if not df.empty:
-                incoming_types = ['in', 'incoming', 'received', 'inbound', 'входящий']
-                incoming_calls = df[df['type'].str.lower().isin(incoming_types)]
-                
-                for _, call in incoming_calls.iterrows():
-                    incoming_numbers.append({
-                        'Сотрудник': f"{employee.get('last_name', '')} {employee.get('first_name', '')}".strip(),
-                        'Отдел': get_department_numbers(employee['department']),
-                        'Входящий номер': call.get('from', call.get('caller', 'Неизвестно')),
-                        'Дата/время': call.get('start', call.get('date', 'Неизвестно')),
-                        'Длительность': call.get('duration', call.get('length', 'Неизвестно')),
-                        'Статус': call.get('status', 'Неизвестно')
-                    })
+        # Получаем данные звонков параллельно
+        histories = await fetch_call_histories(
+            employees, start_date_str, end_date_str,
+            on_progress=make_fetch_progress(query, "🔄 Формирую отчет по входящим номерам..."),
+            fetch=fetch_call_records
+        )
         
-        if not incoming_numbers:
+        # Оставляем сотрудников с входящими звонками (маска по колонке направления)
+        with_incoming = [
+            (employee, records) for employee, records in zip(employees, histories) if records.incoming().any()
+        ]
+        if not with_incoming:
             await safe_edit_message(query, "❌ Нет входящих звонков за указанный период", 
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
             )
             return
-        
-        # Создаем DataFrame
-        df_incoming = pd.DataFrame(incoming_numbers)
-        
-        # Сортируем по дате/времени
-        if 'Дата/время' in df_incoming.columns:
-            df_incoming = df_incoming.sort_values('Дата/время', ascending=False)
+        employees, histories = (list(column) for column in zip(*with_incoming))
         
         # Формируем имя файла
         period_info = get_period_dates_info(period, context)
         filename = f"incoming_numbers_{dept_number if dept_number != 'all' else 'all'}_{period_info.replace(':', '').replace(' ', '_').replace('/', '_')}.xlsx"
         
-        # Отправляем файл
-        await send_excel(df_incoming, filename, query.message.chat_id, context)
+        # Пишем строки в книгу потоком вне цикла событий и отправляем файл
+        with report_buffer() as buffer:
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            written = await loop.run_in_executor(None, write_incoming_excel, buffer, employees, histories)
+            logger.info(f"Отчет по входящим номерам: {written} строк за {time.monotonic() - started:.2f} с")
+            await send_document_buffer(buffer, filename, query.message.chat_id, context)
         
         await safe_edit_message(query, 
             f"✅ Отчет по входящим номерам отправлен! ({period_info})",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
         
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
     except Exception as e:
         logger.error(f"Ошибка при создании отчета по входящим номерам: {str(e)}")
         await safe_edit_message(query, 
@@ -1614,6 +2120,171 @@ async def handle_incoming_numbers_excel(query, context, sheet_type, dept_number,
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
         )
 
+async def handle_unique_callers(query, context, dept_number, period):
+    """
+    Обработка формата "Уникальные клиенты" - число различных входящих номеров по отделам
+
+    Короткие периоды (до UNIQUE_EXACT_DAYS дней) считаются точно по звонкам, длинные - слиянием
+    дневных регистров HyperLogLog сотрудников отдела; рядом с приблизительным числом выводится ошибка.
+    """
+    try:
+        await safe_edit_message(query, "🔄 Считаю уникальных клиентов...", reply_markup=None)
+        
+        # Сотрудники из кэша провайдера; при устаревшем кэше - запрос к API, поэтому в отдельном потоке
+        loop = asyncio.get_running_loop()
+        employees = await loop.run_in_executor(None, employee_provider.get_employees)
+        if dept_number != "all":
+            employees = [employee for employee in employees if get_department_numbers(employee['department']) == dept_number]
+        employees = [employee for employee in employees if employee.get('sim') and employee['sim'] != 'Нет данных']
+        if not employees:
+            await safe_edit_message(query, "❌ Нет данных сотрудников", 
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+            )
+            return
+        
+        start_date_str, end_date_str = get_period_dates(period, context)
+        days = (datetime.strptime(end_date_str, "%Y-%m-%d") - datetime.strptime(start_date_str, "%Y-%m-%d")).days + 1
+        exact = days <= UNIQUE_EXACT_DAYS
+        on_progress = make_fetch_progress(query, "🔄 Считаю уникальных клиентов...")
+        departments = [_export_value(get_department_numbers(employee['department'])) for employee in employees]
+        
+        counters = {}
+        total = set() if exact else HyperLogLog()
+        if exact or call_store is None:
+            # Входящие номера из колонок звонков; без хранилища длинный период тоже считается HyperLogLog
+            histories = await fetch_call_histories(
+                employees, start_date_str, end_date_str, on_progress=on_progress, fetch=fetch_call_records
+            )
+            for department, records in zip(departments, histories):
+                counter = counters.setdefault(department, set() if exact else HyperLogLog())
+                callers = np.unique(records.from_id[records.incoming()])
+                for caller in (normalize_phone(records.phones[caller_id]) for caller_id in callers):
+                    if caller:
+                        counter.add(caller)
+            for counter in counters.values():
+                if exact:
+                    total |= counter
+                else:
+                    total.merge(counter)
+        else:
+            employee_counters = await fetch_call_histories(
+                employees, start_date_str, end_date_str, on_progress=on_progress, fetch=fetch_caller_counter
+            )
+            for department, counter in zip(departments, employee_counters):
+                counters.setdefault(department, HyperLogLog()).merge(counter)
+                total.merge(counter)
+        
+        def format_count(counter):
+            if exact:
+                return str(len(counter))
+            return f"≈{counter.count()} ±{counter.relative_error * 100:.1f}%"
+        
+        table = PrettyTable()
+        table.field_names = ["Отдел", "Уникальных клиентов"]
+        for department in sorted(counters, key=lambda dept: (not dept.isdigit(), int(dept) if dept.isdigit() else 0, dept)):
+            table.add_row([department, format_count(counters[department])])
+        if len(counters) > 1:
+            table.add_row(["ИТОГО", format_count(total)])
+        
+        period_info = get_period_dates_info(period, context)
+        mode = "точный подсчёт" if exact else "оценка HyperLogLog"
+        await safe_edit_message(query, f"👥 Уникальные клиенты ({period_info}, {mode}):\n\n`{table}`", parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+        )
+        
+    except VatsUnavailableError as e:
+        await notify_vats_unavailable(query, e)
+    except Exception as e:
+        logger.error(f"Ошибка при подсчёте уникальных клиентов: {str(e)}")
+        await safe_edit_message(query, 
+            f"❌ Ошибка при подсчёте уникальных клиентов: {str(e)}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]])
+        )
+
+def _prefetch_calls(day, phone_number):
+    # Чтение через кэш/хранилище сохраняет день локально
+    return sum(1 for _ in _iter_calls_strict(day, day, phone_number))
+
+async def prefetch_calls(day=None, concurrency=None):
+    """
+    Загрузка звонков за день по всем SIM активных сотрудников в кэш и локальное хранилище
+
+    Args:
+        day (str): День в формате YYYY-MM-DD (по умолчанию вчерашний)
+        concurrency (int): Число одновременных запросов (по умолчанию PREFETCH_CONCURRENCY)
+
+    Returns:
+        dict: {'day', 'phones', 'calls', 'errors', 'seconds'}
+    """
+    day = day or (get_actual_now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    employees = await loop.run_in_executor(_fetch_executor, employee_provider.get_employees)
+    phones = list(dict.fromkeys(employee['sim'] for employee in employees if employee.get('sim')))
+    semaphore = asyncio.Semaphore(concurrency or PREFETCH_CONCURRENCY)
+
+    async def prefetch_one(phone):
+        async with semaphore:
+            return await loop.run_in_executor(_fetch_executor, _prefetch_calls, day, phone)
+
+    results = await asyncio.gather(*(prefetch_one(phone) for phone in phones), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    stats = {
+        'day': day,
+        'phones': len(phones),
+        'calls': sum(result for result in results if not isinstance(result, Exception)),
+        'errors': len(errors),
+        'seconds': time.monotonic() - started
+    }
+    logger.info(
+        f"Предзагрузка звонков за {day} завершена: номеров {stats['phones']}, звонков {stats['calls']}, "
+        f"ошибок {stats['errors']}, {stats['seconds']:.1f} с"
+    )
+    if errors:
+        logger.warning(f"Первая ошибка предзагрузки: {errors[0]}")
+    return stats
+
+async def prefetch_job(context):
+    """Задача JobQueue: ночная предзагрузка звонков за прошедший день"""
+    try:
+        await prefetch_calls()
+    except Exception as e:
+        logger.error(f"Ошибка предзагрузки звонков: {e}")
+
+async def today_poll_job(context):
+    """Задача JobQueue: опрос новых звонков за сегодня для счётчиков"""
+    try:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_fetch_executor, today_counters.poll)
+    except Exception as e:
+        logger.warning(f"Ошибка опроса звонков за сегодня: {e}")
+
+def schedule_today_poll(application):
+    """Периодический опрос звонков за сегодня каждые TODAY_POLL_INTERVAL секунд"""
+    if today_counters is None:
+        return
+    if application.job_queue is None:
+        logger.warning("Опрос звонков за сегодня не запущен: установите python-telegram-bot[job-queue]")
+        return
+    application.job_queue.run_repeating(today_poll_job, interval=TODAY_POLL_INTERVAL, first=1, name="today_poll")
+    logger.info(f"Опрос звонков за сегодня каждые {TODAY_POLL_INTERVAL} с")
+
+def schedule_prefetch(application):
+    """Ежедневный запуск предзагрузки звонков в PREFETCH_TIME"""
+    if not PREFETCH_TIME:
+        return
+    if call_cache is None and call_store is None:
+        logger.info("Предзагрузка звонков не запланирована: кэш и локальное хранилище отключены")
+        return
+    if application.job_queue is None:
+        logger.warning("Предзагрузка звонков не запланирована: установите python-telegram-bot[job-queue]")
+        return
+    hour, minute = (int(part) for part in PREFETCH_TIME.split(":"))
+    # Время задаётся по часовому поясу сервера, а не UTC планировщика
+    run_at = dt_time(hour, minute, tzinfo=datetime.now().astimezone().tzinfo)
+    application.job_queue.run_daily(prefetch_job, time=run_at, name="prefetch_calls")
+    logger.info(f"Предзагрузка звонков запланирована на {PREFETCH_TIME} ежедневно")
+
 def main():
     global bot_application
     
@@ -1644,6 +2315,8 @@ def main():
             logger.error(f"❌ Не удалось обновить кэш сотрудников при старте: {e}")
     
     application.post_init = on_startup
+    schedule_prefetch(application)
+    schedule_today_poll(application)
     
     application.run_polling()
 
@@ -0,0 +1,76 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+def estimate_size(calls):
+    """Приблизительный размер списка звонков в памяти, байт"""
+    size = sys.getsizeof(calls)
+    for call in calls:
+        size += sys.getsizeof(call)
+        for value in call.values():
+            size += sys.getsizeof(value)
+    return size
+
+class CallCache:
+    """
+    LRU-кэш истории звонков в памяти по ключу (номер, день)
+
+    Размер ограничен в байтах, при переполнении вытесняются давно не использованные дни.
+    Закрытые дни не устаревают, записи за текущий день живут today_ttl секунд.
+    Списки звонков отдаются без копирования - изменять их нельзя.
+    """
+
+    def __init__(self, max_bytes, today_ttl=120):
+        self.max_bytes = max_bytes
+        self.today_ttl = today_ttl
+        self._entries = OrderedDict()  # (phone, day) -> (calls, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phone, day):
+        """
+        Звонки номера за день или None, если дня нет в кэше
+        """
+        key = (phone, day)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, phone, day, calls):
+        size = estimate_size(calls)
+        if size > self.max_bytes:
+            return
+        today = datetime.now().strftime("%Y-%m-%d")
+        expires_at = None if day < today else time.monotonic() + self.today_ttl
+        key = (phone, day)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (calls, size, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """
+        Returns:
+            dict: {'hits', 'misses', 'entries', 'bytes'}
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._bytes}
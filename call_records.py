@@ -0,0 +1,236 @@
+"""
+Компактное колоночное хранение звонков
+"""
+
+import re
+import sys
+
+import numpy as np
+
+from call_stats import classifier, DIRECTION_IN, STATUS_MISSED
+
+# Столько звонков накапливается в списках Python перед переводом в массивы NumPy
+CHUNK_SIZE = 4096
+# Пропущенная длительность и предел int32
+NO_DURATION = -1
+MAX_DURATION = 2 ** 31 - 1
+# Время начала в виде, который восстанавливается из datetime64[s] без изменений
+_PLAIN_START = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\Z')
+
+
+class _Vocabulary:
+    """Интернирование строк: значение -> целочисленный идентификатор"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.values = []
+        self._ids = {}
+
+    def id(self, value):
+        try:
+            return self._ids[value]
+        except TypeError:  # нехешируемое значение
+            return self.id(None)
+        except KeyError:
+            pass
+        if value is not None and self.limit is not None and len(self.values) >= self.limit - 1:
+            # Словарь заполнен: остальные значения сводятся к пустому (последнее место оставлено для None)
+            return self.id(None)
+        self._ids[value] = len(self.values)
+        self.values.append(value)
+        return self._ids[value]
+
+
+def _parse_starts(values):
+    # Берётся время без часового пояса, как в исходной строке (call_day тоже режет строку)
+    values = [value[:19] if isinstance(value, str) else None for value in values]
+    try:
+        return np.array(values, dtype='datetime64[s]')
+    except ValueError:
+        parsed = np.empty(len(values), dtype='datetime64[s]')
+        for position, value in enumerate(values):
+            try:
+                parsed[position] = np.datetime64(value, 's') if value else np.datetime64('NaT')
+            except ValueError:
+                parsed[position] = np.datetime64('NaT')
+        return parsed
+
+
+def _is_plain_start(value):
+    """Строка времени, которую колонка start передаёт без потерь ('YYYY-MM-DD HH:MM:SS')"""
+    return isinstance(value, str) and _PLAIN_START.match(value) is not None
+
+
+def _parse_duration(value):
+    try:
+        return min(max(int(value), 0), MAX_DURATION)
+    except (TypeError, ValueError, OverflowError):
+        return NO_DURATION
+
+
+class CallRecords:
+    """
+    Звонки в колоночном виде вместо списка словарей
+
+    Колонки: start (datetime64[s]), duration (int32, -1 - нет данных), direction (uint8, код CallClassifier),
+    status_id (uint8, индекс в statuses), from_id и to_id (int32, индексы в phones).
+    Номера и статусы интернированы, поэтому звонок занимает десятки байт вместо сотен.
+    Значения start и duration, которые типизированная колонка передаёт с потерями (время не в виде
+    'YYYY-MM-DD HH:MM:SS', с часовым поясом, длительность не целым числом), хранятся как есть
+    в raw_starts и raw_durations (позиция звонка -> исходное значение) и отдаются в column.
+    Содержимое только для чтения.
+    """
+
+    def __init__(self, start, duration, direction, status_id, from_id, to_id, statuses, phones,
+                 raw_starts=None, raw_durations=None):
+        self.start = start
+        self.duration = duration
+        self.direction = direction
+        self.status_id = status_id
+        self.from_id = from_id
+        self.to_id = to_id
+        self.statuses = statuses
+        self.phones = phones
+        self.raw_starts = raw_starts or {}
+        self.raw_durations = raw_durations or {}
+
+    @classmethod
+    def from_calls(cls, calls):
+        """
+        Сборка из итерируемых звонков (в том числе генератора страниц API) за один проход
+
+        Звонки переводятся в массивы порциями по CHUNK_SIZE, поэтому список словарей целиком не хранится.
+        """
+        statuses = _Vocabulary(limit=256)
+        phones = _Vocabulary()
+        chunks = []
+        raw_starts, raw_durations = {}, {}
+        flushed = 0  # звонков в готовых порциях
+        starts, durations, directions, status_ids, from_ids, to_ids = [], [], [], [], [], []
+
+        def flush():
+            nonlocal flushed
+            parsed = _parse_starts(starts)
+            for position, value in enumerate(starts):
+                if value is not None and (not _is_plain_start(value) or np.isnat(parsed[position])):
+                    raw_starts[flushed + position] = value
+            flushed += len(starts)
+            chunks.append((
+                parsed,
+                np.array(durations, dtype=np.int32),
+                np.array(directions, dtype=np.uint8),
+                np.array(status_ids, dtype=np.uint8),
+                np.array(from_ids, dtype=np.int32),
+                np.array(to_ids, dtype=np.int32),
+            ))
+            for column in (starts, durations, directions, status_ids, from_ids, to_ids):
+                column.clear()
+
+        for call in calls:
+            starts.append(call.get('start', call.get('date')))
+            value = call.get('duration', call.get('length'))
+            duration = _parse_duration(value)
+            if value is not None and not (type(value) is int and value == duration):
+                raw_durations[flushed + len(durations)] = value
+            durations.append(duration)
+            directions.append(classifier.call_direction(call))
+            status_ids.append(statuses.id(call.get('status')))
+            from_ids.append(phones.id(call.get('from', call.get('caller'))))
+            to_ids.append(phones.id(call.get('to')))
+            if len(starts) >= CHUNK_SIZE:
+                flush()
+        if starts or not chunks:
+            flush()
+
+        columns = [np.concatenate(parts) if len(chunks) > 1 else parts[0] for parts in zip(*chunks)]
+        return cls(*columns, statuses=statuses.values, phones=phones.values,
+                   raw_starts=raw_starts, raw_durations=raw_durations)
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def nbytes(self):
+        """Приблизительный размер в памяти, байт"""
+        arrays = (self.start, self.duration, self.direction, self.status_id, self.from_id, self.to_id)
+        strings = sum(sys.getsizeof(value) for value in self.phones) + sum(sys.getsizeof(value) for value in self.statuses)
+        raw = sum(
+            sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values.values())
+            for values in (self.raw_starts, self.raw_durations)
+        )
+        return (
+            sys.getsizeof(self) + sum(array.nbytes for array in arrays)
+            + sys.getsizeof(self.phones) + sys.getsizeof(self.statuses) + strings + raw
+        )
+
+    def missed(self):
+        """Маска пропущенных звонков"""
+        table = np.array([classifier.status(value) == STATUS_MISSED for value in self.statuses], dtype=bool)
+        return table[self.status_id]
+
+    def incoming(self):
+        """Маска входящих звонков"""
+        return self.direction == DIRECTION_IN
+
+    def column(self, name, mask=None):
+        """
+        Колонка в исходных значениях (номера и статусы строками, время строкой YYYY-MM-DD HH:MM:SS,
+        а время и длительность, не представимые в колонке, - как пришли от API)
+
+        Args:
+            name (str): 'start', 'duration', 'status', 'from' или 'to'
+            mask: Маска или индексы отбираемых звонков
+
+        Returns:
+            numpy.ndarray: Значения (None там, где данных нет)
+        """
+        select = (lambda array: array) if mask is None else (lambda array: array[mask])
+        if name == 'start':
+            starts = select(self.start)
+            values = np.char.replace(np.datetime_as_string(starts, unit='s'), 'T', ' ').astype(object)
+            values[np.isnat(starts)] = None
+            return self._restore(values, self.raw_starts, mask)
+        if name == 'duration':
+            values = select(self.duration).astype(object)
+            values[values == NO_DURATION] = None
+            return self._restore(values, self.raw_durations, mask)
+        if name == 'status':
+            return np.array(self.statuses, dtype=object)[select(self.status_id)]
+        if name in ('from', 'to'):
+            ids = select(self.from_id if name == 'from' else self.to_id)
+            return np.array(self.phones, dtype=object)[ids]
+        raise KeyError(name)
+
+    def _restore(self, values, raw, mask):
+        # Исходные значения на место тех, что колонка передаёт с потерями
+        if not raw:
+            return values
+        positions = np.arange(len(self)) if mask is None else np.asarray(mask)
+        if positions.dtype == bool:
+            positions = np.flatnonzero(positions)
+        raw_positions = np.fromiter(raw, dtype=np.int64, count=len(raw))
+        for index in np.flatnonzero(np.isin(positions, raw_positions)):
+            values[index] = raw[int(positions[index])]
+        return values
+
+
+# 1970-01-01 - четверг: сдвиг, после которого день недели 0 - понедельник
+_EPOCH_WEEKDAY = 3
+
+
+def hour_weekday_counts(histories):
+    """
+    Количество звонков по дню недели и часу начала одним bincount по всем CallRecords
+
+    Args:
+        histories: CallRecords (например, по сотрудникам отдела)
+
+    Returns:
+        numpy.ndarray: Матрица 7 x 24 (строки - дни недели с понедельника, колонки - часы)
+    """
+    starts = np.concatenate([records.start for records in histories] or [np.empty(0, 'datetime64[s]')])
+    starts = starts[~np.isnat(starts)]
+    seconds = starts.astype('datetime64[s]').astype(np.int64)
+    days, second_of_day = np.divmod(seconds, 86400)
+    cells = (days + _EPOCH_WEEKDAY) % 7 * 24 + second_of_day // 3600
+    return np.bincount(cells, minlength=7 * 24).reshape(7, 24)
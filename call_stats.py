@@ -0,0 +1,178 @@
+"""
+Подсчёт статистики звонков
+"""
+
+from duration_sketch import DurationSketch
+
+# Значения type/status, по которым классифицируются звонки
+INCOMING_TYPES = ('in', 'incoming', 'received', 'inbound', 'входящий')
+OUTGOING_TYPES = ('out', 'outgoing', 'исходящий')
+MISSED_STATUSES = ('noanswer', 'missed', 'пропущен', 'неотвечен', 'нет ответа')
+
+SUMMARY_FIELDS = ('incoming', 'outgoing', 'missed', 'total', 'talk_seconds')
+# Перцентили длительности разговора в отчётах: медиана и p90
+TALK_QUANTILES = (0.5, 0.9)
+
+# Коды классификации звонка
+DIRECTION_OTHER, DIRECTION_IN, DIRECTION_OUT = 0, 1, 2
+STATUS_OTHER, STATUS_MISSED = 0, 1
+
+
+class CallClassifier:
+    """
+    Перевод сырых значений type/direction/status в целочисленные коды
+
+    Каждое значение приводится к нижнему регистру и сверяется со списками один раз,
+    дальше код берётся из словаря. Словари ограничены max_values значениями:
+    непредвиденные значения сверх лимита классифицируются без запоминания.
+    """
+
+    def __init__(self, max_values=4096):
+        self.max_values = max_values
+        self._directions = {}
+        self._statuses = {}
+
+    @staticmethod
+    def _classify_direction(value):
+        if isinstance(value, str):
+            value = value.lower()
+            if value in INCOMING_TYPES:
+                return DIRECTION_IN
+            if value in OUTGOING_TYPES:
+                return DIRECTION_OUT
+        return DIRECTION_OTHER
+
+    @staticmethod
+    def _classify_status(value):
+        if isinstance(value, str) and value.lower() in MISSED_STATUSES:
+            return STATUS_MISSED
+        return STATUS_OTHER
+
+    def _lookup(self, memo, classify, value):
+        # Гонка потоков при заполнении безвредна: для значения всегда вычисляется один и тот же код
+        try:
+            return memo[value]
+        except KeyError:
+            code = classify(value)
+            if len(memo) < self.max_values:
+                memo[value] = code
+            return code
+        except TypeError:  # нехешируемое значение (список, словарь)
+            return classify(value)
+
+    def direction(self, value):
+        return self._lookup(self._directions, self._classify_direction, value)
+
+    def status(self, value):
+        return self._lookup(self._statuses, self._classify_status, value)
+
+    def call_direction(self, call):
+        """Направление звонка по полю type, а если оно не распознано - по полю direction"""
+        value = call.get('type')
+        try:
+            code = self._directions[value]
+        except (KeyError, TypeError):
+            code = self.direction(value)
+        if code == DIRECTION_OTHER:
+            code = self.direction(call.get('direction'))
+        return code
+
+    def call_status(self, call):
+        value = call.get('status')
+        try:
+            return self._statuses[value]
+        except (KeyError, TypeError):
+            return self.status(value)
+
+
+# Общий классификатор для всех отчётов
+classifier = CallClassifier()
+
+
+def empty_summary():
+    """Пустая статистика: счётчики SUMMARY_FIELDS и гистограмма длительностей разговоров durations"""
+    return {'incoming': 0, 'outgoing': 0, 'missed': 0, 'total': 0, 'talk_seconds': 0, 'durations': DurationSketch()}
+
+
+def call_duration(call):
+    """Длительность звонка в секундах (0, если не указана)"""
+    try:
+        return max(int(call.get('duration', call.get('length')) or 0), 0)
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+
+def merge_summary(summary, other):
+    """Прибавляет статистику other к summary (изменяется на месте)"""
+    for field in SUMMARY_FIELDS:
+        summary[field] += other[field]
+    if other.get('durations') is not None:
+        summary.setdefault('durations', DurationSketch()).merge(other['durations'])
+    return summary
+
+
+def talk_percentiles(sketch):
+    """
+    Перцентили TALK_QUANTILES длительности разговора по гистограмме
+
+    Args:
+        sketch (DurationSketch): Гистограмма длительностей (None - нет данных)
+
+    Returns:
+        list: Длительности в целых секундах (None, если разговоров не было)
+    """
+    values = [sketch.quantile(q) if sketch is not None else None for q in TALK_QUANTILES]
+    return [round(value) if value is not None else None for value in values]
+
+
+def add_call(summary, call):
+    """
+    Учёт одного звонка в статистике summary (изменяется на месте)
+    """
+    summary['total'] += 1
+    direction = classifier.call_direction(call)
+    if direction == DIRECTION_IN:
+        summary['incoming'] += 1
+    elif direction == DIRECTION_OUT:
+        summary['outgoing'] += 1
+    if classifier.call_status(call) == STATUS_MISSED:
+        summary['missed'] += 1
+    duration = call_duration(call)
+    summary['talk_seconds'] += duration
+    summary['durations'].add(duration)
+
+
+def summarize_calls(calls):
+    """
+    Подсчёт входящих, исходящих и пропущенных звонков за один проход
+
+    Принимает любой итерируемый источник звонков (в том числе генератор страниц API),
+    поэтому полный список звонков в памяти не нужен.
+
+    Args:
+        calls: Итерируемый набор звонков (dict)
+
+    Returns:
+        dict: {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds', 'durations'}
+    """
+    summary = empty_summary()
+    for call in calls:
+        add_call(summary, call)
+    return summary
+
+
+def summarize_calls_by(calls, key):
+    """
+    Статистика звонков с разбивкой по ключу key(call) за один проход
+
+    Returns:
+        dict: {ключ: {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds', 'durations'}}
+    """
+    summaries = {}
+    for call in calls:
+        group = key(call)
+        summary = summaries.get(group)
+        if summary is None:
+            summary = summaries[group] = empty_summary()
+        add_call(summary, call)
+    return summaries
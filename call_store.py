@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from call_stats import SUMMARY_FIELDS, DIRECTION_IN, classifier, empty_summary, add_call
+from duration_sketch import DurationSketch
+from employee_data_provider import normalize_phone
+from hyperloglog import HyperLogLog, sparse_registers
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    phone TEXT NOT NULL,
+    day TEXT NOT NULL,
+    start TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_calls_phone_day ON calls (phone, day);
+CREATE TABLE IF NOT EXISTS synced_days (
+    phone TEXT NOT NULL,
+    day TEXT NOT NULL,
+    synced_at TEXT NOT NULL,
+    PRIMARY KEY (phone, day)
+);
+CREATE TABLE IF NOT EXISTS daily_stats (
+    phone TEXT NOT NULL,
+    day TEXT NOT NULL,
+    incoming INTEGER NOT NULL,
+    outgoing INTEGER NOT NULL,
+    missed INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    talk_seconds INTEGER NOT NULL,
+    talk_sketch TEXT,
+    callers_hll TEXT,
+    PRIMARY KEY (phone, day)
+);
+"""
+
+# Версия схемы в PRAGMA user_version: 1 - добавлена таблица daily_stats, 2 - гистограммы длительностей talk_sketch,
+# 3 - регистры HyperLogLog входящих номеров callers_hll
+SCHEMA_VERSION = 3
+# Колонки daily_stats, добавленные после версии 1
+DAILY_STATS_COLUMNS = ('talk_sketch', 'callers_hll')
+# Начало поля start с днём звонка
+_DAY_PREFIX = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def iter_days(start_date, end_date):
+    """Дни периода включительно в формате YYYY-MM-DD"""
+    day = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    while day <= end:
+        yield day.strftime("%Y-%m-%d")
+        day += timedelta(days=1)
+
+def group_day_runs(days):
+    """Разбивает отсортированный список дней на непрерывные интервалы (start, end)"""
+    runs = []
+    for day in days:
+        if runs:
+            prev_end = datetime.strptime(runs[-1][1], "%Y-%m-%d").date()
+            if datetime.strptime(day, "%Y-%m-%d").date() == prev_end + timedelta(days=1):
+                runs[-1] = (runs[-1][0], day)
+                continue
+        runs.append((day, day))
+    return runs
+
+def split_day_range(start_date, end_date, days):
+    """
+    Разбивает период на последовательные интервалы не длиннее days дней
+
+    Returns:
+        list: Интервалы (start, end) в формате YYYY-MM-DD
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    parts = []
+    while start <= end:
+        part_end = min(end, start + timedelta(days=days - 1))
+        parts.append((start.strftime("%Y-%m-%d"), part_end.strftime("%Y-%m-%d")))
+        start = part_end + timedelta(days=1)
+    return parts
+
+def count_daily_call(stats, key, call):
+    """Учёт звонка в статистике дня stats[key]: счётчики, длительности и различные входящие номера"""
+    summary = stats.get(key)
+    if summary is None:
+        summary = stats[key] = {**empty_summary(), 'callers': set()}
+    add_call(summary, call)
+    if classifier.call_direction(call) == DIRECTION_IN:
+        caller = normalize_phone(call.get('from', call.get('caller')))
+        if caller:
+            summary['callers'].add(caller)
+
+def call_day(call, default=None):
+    """День звонка по полю start ('YYYY-MM-DD HH:MM:SS' или ISO); default, если день не распознан"""
+    start = call.get('start') or call.get('date')
+    if isinstance(start, str) and _DAY_PREFIX.match(start):
+        return start[:10]
+    return default
+
+def run_day(call, run_start, run_end):
+    """
+    День звонка из ответа API за дни run_start - run_end
+
+    Звонок всегда остаётся в диапазоне: без распознанного дня (нет start, формат не ISO) он относится
+    к run_start, день вне диапазона (сдвиг часового пояса на границе дня) - к ближайшему дню диапазона.
+
+    Returns:
+        tuple: (день, распознан ли день звонка внутри диапазона)
+    """
+    day = call_day(call)
+    if day is None or day < run_start:
+        return run_start, False
+    if day > run_end:
+        return run_end, False
+    return day, True
+
+class CallStore:
+    """
+    Локальное хранилище истории звонков в SQLite
+
+    Звонки хранятся по (номер, день). Таблица synced_days отмечает полностью загруженные дни:
+    закрытые дни больше не запрашиваются у API, текущий день перезагружается при каждом обращении.
+    Таблица daily_stats хранит статистику по (номер, день) и обновляется вместе со звонками,
+    поэтому статистика за любой период - сумма нескольких строк, а не пересчёт звонков.
+    Перцентили длительности разговоров и число различных входящих номеров считаются так же:
+    слиянием дневных гистограмм talk_sketch и регистров HyperLogLog callers_hll.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Отдельное соединение на поток: пул загрузки пишет и читает параллельно
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(daily_stats)")}
+                for column in DAILY_STATS_COLUMNS:
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE daily_stats ADD COLUMN {column} TEXT")
+                self._rebuild_daily_stats(conn)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _rebuild_daily_stats(self, conn):
+        # Статистика по звонкам, сохранённым до появления daily_stats
+        stats = {}
+        for phone, day, data in conn.execute("SELECT phone, day, data FROM calls"):
+            count_daily_call(stats, (phone, day), json.loads(data))
+        conn.execute("DELETE FROM daily_stats")
+        self._insert_daily_stats(conn, stats)
+        if stats:
+            logger.info(f"Хранилище звонков: статистика по дням пересчитана для {len(stats)} записей")
+
+    @staticmethod
+    def _insert_daily_stats(conn, stats):
+        conn.executemany(
+            "INSERT OR REPLACE INTO daily_stats "
+            "(phone, day, incoming, outgoing, missed, total, talk_seconds, talk_sketch, callers_hll) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    phone, day, *(summary[field] for field in SUMMARY_FIELDS),
+                    summary['durations'].to_json(), sparse_registers(summary['callers'])
+                )
+                for (phone, day), summary in stats.items()
+            ]
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _today():
+        return datetime.now().strftime("%Y-%m-%d")
+
+    def missing_days(self, phone, start_date, end_date):
+        """
+        Дни периода, которых нет в хранилище (текущий и будущие дни всегда считаются недогруженными)
+
+        Returns:
+            list: Дни в формате YYYY-MM-DD
+        """
+        rows = self._connect().execute(
+            "SELECT day FROM synced_days WHERE phone = ? AND day BETWEEN ? AND ?",
+            (phone, start_date, end_date)
+        ).fetchall()
+        synced = {row[0] for row in rows}
+        today = self._today()
+        return [day for day in iter_days(start_date, end_date) if day not in synced or day >= today]
+
+    def sync(self, phone, start_date, end_date, fetch):
+        """
+        Догрузка недостающих дней периода
+
+        Args:
+            phone (str): Номер телефона сотрудника
+            start_date (str): Дата начала в формате YYYY-MM-DD
+            end_date (str): Дата окончания в формате YYYY-MM-DD
+            fetch: Функция fetch(start_date, end_date, phone), возвращающая итерируемые звонки
+
+        Returns:
+            int: Количество запрошенных у API интервалов
+        """
+        runs = group_day_runs(self.missing_days(phone, start_date, end_date))
+        for run_start, run_end in runs:
+            self._store_run(phone, run_start, run_end, fetch(run_start, run_end, phone))
+        if runs:
+            logger.debug(f"Хранилище звонков: {phone} догружено интервалов {len(runs)} за {start_date} - {end_date}")
+        return len(runs)
+
+    def _store_run(self, phone, run_start, run_end, calls):
+        # Сначала дочитываем ответ API, чтобы не держать блокировку записи SQLite во время сетевых запросов
+        rows = []
+        stats = {}
+        moved = 0
+        for call in calls:
+            day, exact = run_day(call, run_start, run_end)
+            moved += not exact
+            rows.append((phone, day, call.get('start'), json.dumps(call, ensure_ascii=False)))
+            count_daily_call(stats, (phone, day), call)
+        if moved:
+            logger.warning(
+                f"Звонков {phone} за {run_start} - {run_end} без дня начала в диапазоне: {moved}, "
+                f"отнесены к ближайшему дню диапазона"
+            )
+
+        today = self._today()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "DELETE FROM calls WHERE phone = ? AND day BETWEEN ? AND ?",
+                (phone, run_start, run_end)
+            )
+            conn.executemany("INSERT INTO calls (phone, day, start, data) VALUES (?, ?, ?, ?)", rows)
+            conn.execute(
+                "DELETE FROM daily_stats WHERE phone = ? AND day BETWEEN ? AND ?",
+                (phone, run_start, run_end)
+            )
+            self._insert_daily_stats(conn, stats)
+            synced_at = datetime.now().isoformat(timespec='seconds')
+            conn.executemany(
+                "INSERT OR REPLACE INTO synced_days (phone, day, synced_at) VALUES (?, ?, ?)",
+                [(phone, day, synced_at) for day in iter_days(run_start, run_end) if day < today]
+            )
+
+    def iter_calls(self, phone, start_date, end_date):
+        """
+        Звонки номера за период из хранилища в порядке времени
+
+        Yields:
+            dict: Звонок
+        """
+        cursor = self._connect().execute(
+            "SELECT data FROM calls WHERE phone = ? AND day BETWEEN ? AND ? ORDER BY day, start, rowid",
+            (phone, start_date, end_date)
+        )
+        for (data,) in cursor:
+            yield json.loads(data)
+
+    def _sketches(self, phone, start_date, end_date):
+        # Дневные гистограммы периода: (месяц YYYY-MM, DurationSketch)
+        rows = self._connect().execute(
+            "SELECT substr(day, 1, 7), talk_sketch FROM daily_stats WHERE phone = ? AND day BETWEEN ? AND ?",
+            (phone, start_date, end_date)
+        )
+        return [(month, DurationSketch.from_json(data)) for month, data in rows]
+
+    def summary(self, phone, start_date, end_date):
+        """
+        Статистика номера за период как сумма строк daily_stats
+
+        Период должен быть синхронизирован (sync); за текущий день строка отражает последнюю синхронизацию.
+
+        Returns:
+            dict: {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds', 'durations'}
+        """
+        columns = ", ".join(f"COALESCE(SUM({field}), 0)" for field in SUMMARY_FIELDS)
+        row = self._connect().execute(
+            f"SELECT {columns} FROM daily_stats WHERE phone = ? AND day BETWEEN ? AND ?",
+            (phone, start_date, end_date)
+        ).fetchone()
+        result = dict(zip(SUMMARY_FIELDS, row))
+        result['durations'] = DurationSketch()
+        for _, sketch in self._sketches(phone, start_date, end_date):
+            result['durations'].merge(sketch)
+        return result
+
+    def summary_by_month(self, phone, start_date, end_date):
+        """
+        Статистика номера за период с разбивкой по месяцам из daily_stats
+
+        Returns:
+            dict: {'YYYY-MM': {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds', 'durations'}}
+        """
+        columns = ", ".join(f"SUM({field})" for field in SUMMARY_FIELDS)
+        rows = self._connect().execute(
+            f"SELECT substr(day, 1, 7), {columns} FROM daily_stats "
+            "WHERE phone = ? AND day BETWEEN ? AND ? GROUP BY substr(day, 1, 7)",
+            (phone, start_date, end_date)
+        )
+        result = {row[0]: {**dict(zip(SUMMARY_FIELDS, row[1:])), 'durations': DurationSketch()} for row in rows}
+        for month, sketch in self._sketches(phone, start_date, end_date):
+            result[month]['durations'].merge(sketch)
+        return result
+
+    def unique_callers(self, phones, start_date, end_date):
+        """
+        Счётчик различных входящих номеров по нескольким номерам сотрудников за период
+
+        Слияние дневных регистров callers_hll; период должен быть синхронизирован (sync).
+
+        Args:
+            phones (list): Номера сотрудников
+            start_date (str): Дата начала в формате YYYY-MM-DD
+            end_date (str): Дата окончания в формате YYYY-MM-DD
+
+        Returns:
+            HyperLogLog: Счётчик (оценка - count())
+        """
+        counter = HyperLogLog()
+        placeholders = ", ".join("?" for _ in phones)
+        rows = self._connect().execute(
+            f"SELECT callers_hll FROM daily_stats WHERE phone IN ({placeholders}) AND day BETWEEN ? AND ?",
+            (*phones, start_date, end_date)
+        )
+        for (data,) in rows:
+            counter.merge_json(data)
+        return counter
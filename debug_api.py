@@ -4,9 +4,9 @@
 """
 
 import os
-import requests
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from vats_client import VatsClient
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -21,6 +21,9 @@ def test_api_directly():
     print(f"API_KEY: {API_KEY[:20]}...")
     print(f"API_URL: {API_URL}")
     
+    # Общий клиент ВАТС: все тесты идут через одно keep-alive соединение
+    client = VatsClient(API_KEY, API_URL)
+    
     # Тестовые данные
     start_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
     end_date = datetime.now().strftime("%Y-%m-%d")
@@ -44,8 +47,8 @@ def test_api_directly():
     print(f"Params: {params1}")
     
     try:
-        response1 = requests.get(url1, params=params1, timeout=10)
-        print(f"Status: {response1.status_code}")
+        response1 = client.get('calls', params=params1)
+        print(f"Status: {response1.status_code} ({response1.elapsed.total_seconds() * 1000:.0f} мс)")
         print(f"Response: {response1.text[:200]}...")
     except Exception as e:
         print(f"Error: {e}")
@@ -69,8 +72,8 @@ def test_api_directly():
     print(f"Headers: {headers2}")
     
     try:
-        response2 = requests.get(url2, params=params2, headers=headers2, timeout=10)
-        print(f"Status: {response2.status_code}")
+        response2 = client.get('calls', params=params2, headers=headers2)
+        print(f"Status: {response2.status_code} ({response2.elapsed.total_seconds() * 1000:.0f} мс)")
         print(f"Response: {response2.text[:200]}...")
     except Exception as e:
         print(f"Error: {e}")
@@ -89,8 +92,8 @@ def test_api_directly():
     print(f"Params: {params3}")
     
     try:
-        response3 = requests.get(url3, params=params3, timeout=10)
-        print(f"Status: {response3.status_code}")
+        response3 = client.get(f'calls?api_key={API_KEY}', params=params3)
+        print(f"Status: {response3.status_code} ({response3.elapsed.total_seconds() * 1000:.0f} мс)")
         print(f"Response: {response3.text[:200]}...")
     except Exception as e:
         print(f"Error: {e}")
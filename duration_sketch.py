@@ -0,0 +1,90 @@
+"""
+Сливаемые гистограммы длительности разговоров для перцентилей
+"""
+
+import json
+import math
+
+# Шаг логарифмических корзин: значение восстанавливается с относительной ошибкой не больше ~2.5%
+GAMMA = 1.05
+_LOG_GAMMA = math.log(GAMMA)
+
+
+def bucket_index(seconds):
+    """Номер корзины для длительности в секундах (> 0)"""
+    return int(math.log(seconds) / _LOG_GAMMA)
+
+
+def bucket_value(index):
+    """Представитель корзины - её геометрическая середина, в секундах"""
+    return GAMMA ** (index + 0.5)
+
+
+class DurationSketch:
+    """
+    Гистограмма длительностей разговоров с фиксированными логарифмическими корзинами
+
+    Корзина k содержит длительности из [GAMMA^k, GAMMA^(k+1)), поэтому гистограммы за разные дни
+    и разных сотрудников сливаются сложением счётчиков без потери точности, а перцентиль любого
+    периода и любой группы считается по слитой гистограмме. Звонки без разговора (0 секунд) не учитываются.
+    Для суток хватает ~240 корзин; хранятся только непустые.
+    """
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts) if counts else {}  # номер корзины -> количество разговоров
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, seconds, count=1):
+        if seconds > 0:
+            index = bucket_index(seconds)
+            self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        """Прибавляет other к гистограмме (изменяется на месте)"""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    def copy(self):
+        return DurationSketch(self.counts)
+
+    def quantile(self, q):
+        """
+        Перцентиль длительности разговора (ранг по ближайшему значению)
+
+        Args:
+            q (float): Доля от 0 до 1 (0.5 - медиана, 0.9 - p90)
+
+        Returns:
+            float: Длительность в секундах или None, если разговоров не было
+        """
+        total = len(self)
+        if not total:
+            return None
+        rank = max(math.ceil(q * total), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return bucket_value(index)
+        return bucket_value(max(self.counts))
+
+    def to_json(self):
+        return json.dumps(sorted(self.counts.items()), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(json.loads(data)) if data else cls()
+
+
+def merge_sketches(sketches):
+    """Слияние нескольких гистограмм (None пропускаются) в новую"""
+    merged = DurationSketch()
+    for sketch in sketches:
+        if sketch is not None:
+            merged.merge(sketch)
+    return merged
@@ -3,6 +3,43 @@ from datetime import datetime, timedelta
 import threading
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from single_flight import SingleFlight
+
+# Поля звонка, в которых может встретиться номер сотрудника
+CALL_PHONE_FIELDS = ('phone', 'from', 'to', 'caller', 'diversion')
+
+def normalize_phone(phone):
+    """Последние 10 цифр номера: +7/8 и форматирование не влияют на сравнение"""
+    digits = ''.join(ch for ch in str(phone or '') if ch.isdigit())
+    return digits[-10:] if len(digits) >= 10 else digits
+
+def build_phone_index(employees):
+    """
+    Индекс номер телефона -> позиции сотрудников в списке employees
+
+    Returns:
+        dict: {нормализованный номер: [индексы в employees]}
+    """
+    index = {}
+    for position, emp in enumerate(employees):
+        phone = normalize_phone(emp.get('sim'))
+        if phone:
+            index.setdefault(phone, []).append(position)
+    return index
+
+def match_call_employees(call, phone_index):
+    """
+    Позиции сотрудников, к которым относится звонок (по любому из полей CALL_PHONE_FIELDS)
+
+    Returns:
+        set: Индексы сотрудников
+    """
+    positions = set()
+    for field in CALL_PHONE_FIELDS:
+        value = call.get(field)
+        if value:
+            positions.update(phone_index.get(normalize_phone(value), ()))
+    return positions
 
 class EmployeeDataProvider:
     def __init__(self, api_token, cache_ttl_minutes=10):
@@ -13,6 +50,8 @@ class EmployeeDataProvider:
         self._cache_ttl = timedelta(minutes=cache_ttl_minutes)
         # Заменяем Lock на RLock для избежания дедлока
         self._lock = threading.RLock()
+        # Одновременные обновления кэша выполняют один запрос к API сотрудников
+        self._refresh_flight = SingleFlight()
 
         # Надёжные HTTP-клиент/таймауты/ретраи
         self._session = requests.Session()
@@ -112,7 +151,7 @@ class EmployeeDataProvider:
                 return  # Кэш ещё актуален
         
         # Выносим сетевой запрос из-под лока
-        employees = self._fetch_employees()
+        employees = self._refresh_flight.do('employees', self._fetch_employees)
         
         with self._lock:
             self._cache = self._process_employees(employees)
@@ -3,6 +3,8 @@ import pandas as pd
 from datetime import datetime
 import os
 
+from excel_writer import StreamingWorkbook
+
 class EmployeeExporter:
     def __init__(self, api_token):
         self.api_token = api_token
@@ -207,34 +209,15 @@ class EmployeeExporter:
         df = df.reset_index(drop=True)
         
         try:
-            # Создаем Excel файл с форматированием
-            with pd.ExcelWriter(self.excel_filename, engine='openpyxl') as writer:
-                df.to_excel(writer, sheet_name='Сотрудники', index=False)
-                
-                # Получаем рабочий лист для форматирования
-                worksheet = writer.sheets['Сотрудники']
-                
-                # Автоматическая ширина колонок
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-                
-                # Добавляем информацию об обновлении
-                info_sheet = writer.book.create_sheet('Информация')
-                info_sheet['A1'] = 'Дата последнего обновления:'
-                info_sheet['B1'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                info_sheet['A2'] = 'Количество активных сотрудников:'
-                info_sheet['B2'] = len(df)
+            # Создаем Excel файл потоковой записью с автоматической шириной колонок
+            book = StreamingWorkbook()
+            book.add_frame(df, 'Сотрудники')
+            
+            # Добавляем информацию об обновлении
+            info_sheet = book.add_sheet('Информация')
+            info_sheet.append(['Дата последнего обновления:', datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
+            info_sheet.append(['Количество активных сотрудников:', len(df)])
+            book.save(self.excel_filename)
             
             print(f"Excel файл '{self.excel_filename}' успешно создан/обновлен")
             print(f"Экспортировано активных сотрудников: {len(df)}")
@@ -0,0 +1,139 @@
+"""
+Потоковая запись книг Excel (openpyxl в режиме write_only)
+"""
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
+from openpyxl.utils import get_column_letter
+
+# Предел автоподбора ширины колонки
+MAX_COLUMN_WIDTH = 50
+
+_THIN = Side(style='thin')
+# Заголовок как у DataFrame.to_excel
+FRAME_HEADER = {
+    'font': Font(bold=True),
+    'alignment': Alignment(horizontal='center', vertical='top'),
+    'border': Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN),
+}
+# Заголовок и итоговая строка листов квартального отчёта
+GREY_HEADER = {
+    'font': Font(bold=True),
+    'alignment': Alignment(horizontal='center'),
+    'fill': PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid"),
+}
+TOTAL_ROW = {
+    'font': Font(bold=True),
+    'fill': PatternFill(start_color="E6E6E6", end_color="E6E6E6", fill_type="solid"),
+}
+
+
+def text_width(value):
+    """Длина значения ячейки в символах (пустая ячейка - 0)"""
+    return 0 if value is None else len(str(value))
+
+
+class ColumnWidths:
+    """
+    Ширины колонок по текущим максимумам длины значений
+
+    Максимумы обновляются по мере сборки строк, поэтому второй обход ячеек для автоподбора не нужен.
+    """
+
+    def __init__(self, header):
+        self.maxima = [text_width(value) for value in header]
+
+    def update(self, row):
+        """Учёт строки; возвращает саму строку"""
+        for position, value in enumerate(row):
+            width = text_width(value)
+            if width > self.maxima[position]:
+                self.maxima[position] = width
+        return row
+
+    def update_frame(self, df):
+        """Учёт всех строк DataFrame векторно, по колонкам"""
+        for position, column in enumerate(df.columns):
+            values = df[column].dropna()
+            if len(values):
+                self.maxima[position] = max(self.maxima[position], int(values.astype(str).str.len().max()))
+
+    def widths(self):
+        return [min(width + 2, MAX_COLUMN_WIDTH) for width in self.maxima]
+
+
+class StreamingWorkbook:
+    """
+    Книга openpyxl в режиме write_only
+
+    Строки сразу сериализуются во временный файл листа, объекты ячеек не накапливаются,
+    поэтому память не растёт с числом строк. В этом режиме ширины колонок записываются
+    до первой строки листа и передаются в add_sheet заранее.
+    """
+
+    def __init__(self):
+        self.workbook = Workbook(write_only=True)
+
+    def add_sheet(self, title, header=None, widths=(), header_style=FRAME_HEADER):
+        """
+        Новый лист с шириной колонок и заголовком
+
+        Args:
+            title (str): Название листа
+            header (list): Названия колонок (None - без заголовка)
+            widths (list): Ширины колонок (ColumnWidths.widths)
+            header_style (dict): Стиль ячеек заголовка
+
+        Returns:
+            Лист: строки добавляются sheet.append(row)
+        """
+        sheet = self.workbook.create_sheet(title)
+        for position, width in enumerate(widths, start=1):
+            sheet.column_dimensions[get_column_letter(position)].width = width
+        if header is not None:
+            sheet.append(self.styled(sheet, header, header_style))
+        return sheet
+
+    def add_frame(self, df, title):
+        """
+        Лист из DataFrame без построения объектов ячеек
+
+        Ширины колонок - по максимальной длине значений колонки, пропуски (NaN) - пустые ячейки.
+        """
+        widths = ColumnWidths(df.columns)
+        widths.update_frame(df)
+        sheet = self.add_sheet(title, list(df.columns), widths.widths())
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            sheet.append(row)
+        return sheet
+
+    @staticmethod
+    def styled(sheet, values, style):
+        """Строка ячеек с общим стилем (font, alignment, border, fill)"""
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(sheet, value=value)
+            for name, setting in style.items():
+                setattr(cell, name, setting)
+            cells.append(cell)
+        return cells
+
+    def save(self, target):
+        """Сохранение в файл по пути или в файловый объект"""
+        self.workbook.save(target)
+
+
+def write_frame(target, df, sheet_name='Отчет'):
+    """
+    Запись DataFrame в книгу из одного листа (StreamingWorkbook.add_frame)
+
+    Args:
+        target: Путь к файлу или файловый объект
+        df (DataFrame): Данные
+        sheet_name (str): Название листа
+    """
+    book = StreamingWorkbook()
+    book.add_frame(df, sheet_name)
+    book.save(target)
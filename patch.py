@@ -1,4 +1,5 @@
 import datetime
+import time
 from broker_call_bot import fetch_call_history
 
 # Список сотрудников: (ФИО, номер)
@@ -23,7 +24,9 @@ end_date = today.strftime("%Y-%m-%d")
 for name, phone in employees:
     print(f"\n--- {name} ({phone}) ---")
     try:
+        started = time.monotonic()
         calls = fetch_call_history(start_date, end_date, phone)
+        print(f"  Время запроса: {(time.monotonic() - started) * 1000:.0f} мс")
     except Exception as e:
         print(f"Ошибка запроса: {e}")
         continue
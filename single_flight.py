@@ -0,0 +1,55 @@
+import threading
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов
+
+    Пока запрос с ключом key выполняется, остальные потоки с тем же ключом не запускают
+    его повторно, а ждут и получают тот же результат (или то же исключение).
+    Результат общий для всех ожидающих - изменять его нельзя.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0  # сколько запросов обслужено чужим результатом
+
+    def note_shared(self):
+        """Учесть запрос, объединённый снаружи (например, ожиданием asyncio future)"""
+        with self._lock:
+            self.shared += 1
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Импорт бота без локального хранилища и фонового опроса
+os.environ.setdefault("CALL_STORE_PATH", "")
+os.environ.setdefault("TODAY_POLL_INTERVAL", "0")
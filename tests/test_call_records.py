@@ -0,0 +1,50 @@
+"""
+Колоночные звонки (CallRecords): исходные значения времени и длительности в выгрузке
+"""
+
+import io
+
+import numpy as np
+import openpyxl
+
+import broker_call_bot as bot_module
+import call_records
+from call_records import CallRecords
+
+CALLS = [
+    {'type': 'in', 'status': 'answered', 'from': '79000000001', 'start': '2025-08-01 09:00:00', 'duration': 30},
+    {'type': 'in', 'status': 'answered', 'from': '79000000002', 'start': '2025-08-02T09:00:00+03:00', 'duration': '00:02:05'},
+    {'type': 'in', 'status': 'missed', 'from': '79000000003', 'start': '18.08.2025 10:00:00', 'duration': '125'},
+    {'type': 'out', 'status': 'answered', 'to': '79000000004', 'start': '2025-08-03 11:00:00', 'duration': 7},
+    {'type': 'in', 'status': 'answered', 'from': '79000000005'},
+]
+
+
+def test_columns_keep_values_the_typed_columns_lose(monkeypatch):
+    # Порции по 2 звонка: позиции исходных значений считаются сквозь порции
+    monkeypatch.setattr(call_records, 'CHUNK_SIZE', 2)
+    records = CallRecords.from_calls(CALLS)
+
+    assert list(records.column('start')) == [
+        '2025-08-01 09:00:00', '2025-08-02T09:00:00+03:00', '18.08.2025 10:00:00', '2025-08-03 11:00:00', None
+    ]
+    assert list(records.column('duration')) == [30, '00:02:05', '125', 7, None]
+    assert list(records.column('start', np.array([4, 2]))) == [None, '18.08.2025 10:00:00']
+    assert list(records.column('duration', records.incoming())) == [30, '00:02:05', '125', None]
+
+
+def test_incoming_export_writes_original_values():
+    employee = {'last_name': 'Иванов', 'first_name': 'Иван', 'department': '3', 'sim': '79000000000'}
+    buffer = io.BytesIO()
+
+    written = bot_module.write_incoming_excel(buffer, [employee], [CallRecords.from_calls(CALLS)])
+
+    buffer.seek(0)
+    rows = list(openpyxl.load_workbook(buffer).active.iter_rows(min_row=2, values_only=True))
+    assert written == 4
+    assert {(row[3], row[4]) for row in rows} == {
+        ('2025-08-01 09:00:00', 30),
+        ('2025-08-02T09:00:00+03:00', '00:02:05'),
+        ('18.08.2025 10:00:00', '125'),
+        (bot_module.UNKNOWN_VALUE, bot_module.UNKNOWN_VALUE),
+    }
@@ -0,0 +1,46 @@
+"""
+Локальное хранилище звонков: каждый звонок из ответа API попадает в хранилище и в статистику
+"""
+
+import logging
+
+from call_store import CallStore, run_day
+
+CALLS = [
+    {'id': 1, 'type': 'in', 'status': 'answered', 'start': '2025-08-01 09:00:00', 'duration': 30},
+    {'id': 2, 'type': 'out', 'status': 'answered', 'start': '2025-08-02T23:30:00+03:00', 'duration': 10},
+    # Сдвиг часового пояса на границе дня: по UTC звонок уже за пределами запрошенных дней
+    {'id': 3, 'type': 'in', 'status': 'missed', 'start': '2025-08-04T00:10:00+03:00', 'duration': 0},
+    {'id': 4, 'type': 'in', 'status': 'answered', 'start': '18.08.2025 10:00:00', 'duration': 5},
+    {'id': 5, 'type': 'out', 'status': 'answered', 'duration': 7},
+]
+
+
+def test_run_day_keeps_calls_in_range():
+    assert run_day(CALLS[0], '2025-08-01', '2025-08-03') == ('2025-08-01', True)
+    assert run_day(CALLS[2], '2025-08-01', '2025-08-03') == ('2025-08-03', False)
+    assert run_day(CALLS[3], '2025-08-01', '2025-08-03') == ('2025-08-01', False)
+    assert run_day(CALLS[4], '2025-08-01', '2025-08-03') == ('2025-08-01', False)
+
+
+def test_store_counts_every_call(tmp_path, caplog):
+    store = CallStore(str(tmp_path / 'calls.db'))
+    with caplog.at_level(logging.WARNING):
+        store.sync('100', '2025-08-01', '2025-08-03', lambda start, end, phone: iter(CALLS))
+
+    assert sorted(call['id'] for call in store.iter_calls('100', '2025-08-01', '2025-08-03')) == [1, 2, 3, 4, 5]
+    summary = store.summary('100', '2025-08-01', '2025-08-03')
+    assert (summary['total'], summary['incoming'], summary['outgoing']) == (5, 3, 2)
+    assert "без дня начала в диапазоне: 3" in caplog.text
+
+
+def test_memory_cache_counts_every_call(monkeypatch):
+    import broker_call_bot as bot_module
+    from call_cache import CallCache
+
+    monkeypatch.setattr(bot_module, 'call_cache', CallCache(1024 * 1024))
+    monkeypatch.setattr(bot_module, 'call_store', None)
+    monkeypatch.setattr(bot_module, '_iter_calls_api', lambda start, end, phone: iter(CALLS))
+
+    calls = list(bot_module._iter_calls_cached('2025-08-01', '2025-08-03', '100'))
+    assert sorted(call['id'] for call in calls) == [1, 2, 3, 4, 5]
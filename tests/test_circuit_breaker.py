@@ -0,0 +1,105 @@
+"""
+Учёт потоковых ответов API ВАТС в автомате защиты
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from vats_client import CircuitBreaker, VatsClient, VatsUnavailableError
+
+BODY = b'{"result":[{"id":1,"type":"in"},{"id":2,"type":"out"}]}'
+
+
+class FakeStreamResponse:
+    def __init__(self, status_code=200, error=None):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ''
+        self.error = error
+
+    def iter_content(self, chunk_size=1):
+        yield BODY[:10]
+        if self.error is not None:
+            raise self.error
+        yield BODY[10:]
+
+    def close(self):
+        pass
+
+
+def make_client(response):
+    client = VatsClient('key', 'https://vats.test/crmapi/v1', circuit_breaker=CircuitBreaker(failure_threshold=2))
+    client._session.get = lambda *args, **kwargs: response
+    return client
+
+
+@pytest.mark.parametrize("error", [
+    requests.exceptions.ChunkedEncodingError("обрыв тела"),
+    requests.exceptions.ConnectionError("таймаут чтения тела"),
+])
+def test_body_failure_reaches_breaker(error):
+    client = make_client(FakeStreamResponse(error=error))
+    for _ in range(2):
+        with pytest.raises(type(error)):
+            client.get_calls_page('2026-10-18', '2026-10-18', None, 1)
+    assert client.circuit_breaker.state == 'open'
+    with pytest.raises(VatsUnavailableError):
+        client.get_calls_page('2026-10-18', '2026-10-18', None, 1)
+
+
+def test_success_recorded_after_body():
+    client = make_client(FakeStreamResponse())
+    client.circuit_breaker.record_failure()
+    response = client.get('calls', stream=True)
+    assert client.circuit_breaker._failures == 1
+    chunks = list(client.iter_body(response))
+    assert b''.join(chunks) == BODY
+    assert client.circuit_breaker._failures == 0
+
+
+def test_closed_reader_releases_probe():
+    client = make_client(FakeStreamResponse())
+    breaker = client.circuit_breaker
+    breaker.reset_timeout = 0
+    breaker.record_failure()
+    breaker.record_failure()
+    calls = client.iter_calls('2026-10-18', '2026-10-18', None)
+    assert next(calls)['id'] == 1
+    calls.close()
+    assert breaker.state == 'closed'
+
+
+def test_hanging_api_is_one_attempt_per_failure():
+    # Сервер принимает соединения и не отвечает: каждый таймаут чтения - одна попытка и одна ошибка автомата
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+    accepted = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            accepted.append(connection)
+
+    threading.Thread(target=accept, daemon=True).start()
+    host, port = server.getsockname()
+    client = VatsClient('key', f'http://{host}:{port}/crmapi/v1', read_timeout=0.3,
+                        circuit_breaker=CircuitBreaker(failure_threshold=2))
+    try:
+        started = time.monotonic()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.get_calls_page('2026-10-18', '2026-10-18', None, 1)
+        assert time.monotonic() - started < 2
+        assert len(accepted) == 1
+        assert client.circuit_breaker._failures == 1
+    finally:
+        server.close()
+        for connection in accepted:
+            connection.close()
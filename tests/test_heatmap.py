@@ -0,0 +1,54 @@
+"""
+Тепловая карта при недоступном API: тестовые данные не строятся и не попадают в кэш
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import broker_call_bot as bot_module
+from call_cache import CallCache
+
+
+class FakeQuery:
+    def __init__(self):
+        self.message = SimpleNamespace(chat_id=1)
+        self.texts = []
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        self.texts.append(text)
+
+
+class FakeBot:
+    def __init__(self):
+        self.photos = []
+
+    async def send_photo(self, chat_id, photo):
+        self.photos.append(photo)
+
+
+@pytest.fixture
+def api_down(monkeypatch):
+    def fail(*args, **kwargs):
+        raise requests.exceptions.ConnectionError("API ВАТС не отвечает")
+
+    employees = [{'last_name': 'Иванов', 'first_name': 'Иван', 'department': '3', 'sim': '79000000001'}]
+    monkeypatch.setattr(bot_module.employee_provider, 'get_employees', lambda: list(employees))
+    monkeypatch.setattr(bot_module.vats_client._session, 'get', fail)
+    monkeypatch.setattr(bot_module.vats_client, 'circuit_breaker', None)
+    bot_module._heatmap_cache.clear()
+    monkeypatch.setattr(bot_module, 'call_cache', CallCache(1024 * 1024))
+    yield
+    bot_module._heatmap_cache.clear()
+
+
+def test_heatmap_not_built_from_test_data(api_down):
+    query, context = FakeQuery(), SimpleNamespace(bot=FakeBot(), user_data={})
+
+    asyncio.run(bot_module.handle_heatmap_format(query, context, "all", "previous_month"))
+
+    assert context.bot.photos == []
+    assert not bot_module._heatmap_cache
+    assert query.texts[-1].startswith("❌")
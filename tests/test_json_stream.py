@@ -0,0 +1,50 @@
+"""
+Потоковый разбор ответа API (iter_json_calls) при любом разбиении тела на фрагменты
+"""
+
+import json
+
+import pytest
+
+from vats_client import iter_json_calls
+
+NUMBERS = [0, -1, 7, 10000000000.0, 0.153, -2.5e-7, 1e21, 6.02e+23, 12345678901234567890, -0.0]
+
+BODIES = [
+    {"result": [1, 10000000000.0]},
+    {"result": [{"uid": "a", "duration": 12}], "elapsed": 0.153},
+    {"data": NUMBERS, "total": 1e5},
+    {"calls": [{"n": value} for value in NUMBERS], "ratio": -3.25E-2},
+    NUMBERS,
+]
+
+
+def chunked(text, size):
+    data = text.encode('utf-8')
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def expected_calls(body):
+    if isinstance(body, list):
+        return body
+    return next(body[key] for key in ('result', 'data', 'calls') if key in body)
+
+
+@pytest.mark.parametrize("body", BODIES)
+@pytest.mark.parametrize("separators", [(',', ':'), (', ', ': ')])
+def test_any_chunk_size(body, separators):
+    text = json.dumps(body, separators=separators)
+    for size in range(1, len(text.encode('utf-8')) + 1):
+        assert list(iter_json_calls(chunked(text, size))) == expected_calls(body), size
+
+
+@pytest.mark.parametrize("text", ['{"result":[1, 10000000000.0]}', '{"result":[],"elapsed": 0.153}'])
+@pytest.mark.parametrize("size", [1, 5, 7])
+def test_number_split_at_chunk_boundary(text, size):
+    assert list(iter_json_calls(chunked(text, size))) == json.loads(text)['result']
+
+
+def test_number_at_end_of_stream():
+    assert list(iter_json_calls(chunked('1.5e3', 2))) == []
+    with pytest.raises(ValueError):
+        list(iter_json_calls(chunked('{"result":[1.]}', 3)))
@@ -0,0 +1,81 @@
+"""
+Ограничение одновременных запросов к API ВАТС вместе с чтением тел ответов
+"""
+
+import threading
+import time
+
+from vats_client import RateLimiter, VatsClient
+
+
+class SlowBodyResponse:
+    """Потоковый ответ, тело которого читается по частям с задержкой"""
+
+    def __init__(self, tracker):
+        self.status_code = 200
+        self.headers = {}
+        self.text = ''
+        self.tracker = tracker
+
+    def iter_content(self, chunk_size=1):
+        self.tracker.enter()
+        try:
+            for chunk in (b'{"result":[', b'{"id":1}', b']}'):
+                time.sleep(0.02)
+                yield chunk
+        finally:
+            self.tracker.leave()
+
+    def close(self):
+        pass
+
+
+class ConcurrencyTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def enter(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+
+def test_body_reads_respect_max_concurrent():
+    tracker = ConcurrencyTracker()
+    limiter = RateLimiter(0, max_concurrent=1)
+    client = VatsClient('key', 'https://vats.test/crmapi/v1', rate_limiter=limiter)
+    client._session.get = lambda *args, **kwargs: SlowBodyResponse(tracker)
+    results = []
+
+    def fetch():
+        results.append(client.get_calls('2026-10-18', '2026-10-18', None))
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [[{'id': 1}]] * 4
+    assert tracker.peak == 1
+    assert limiter.stats() == {'waiting': 0, 'active': 0}
+
+
+def test_error_response_releases_slot():
+    limiter = RateLimiter(0, max_concurrent=1)
+    client = VatsClient('key', 'https://vats.test/crmapi/v1', rate_limiter=limiter)
+    response = SlowBodyResponse(ConcurrencyTracker())
+    response.status_code = 404
+    client._session.get = lambda *args, **kwargs: response
+    for _ in range(2):
+        try:
+            client.get_calls_page('2026-10-18', '2026-10-18', None, 1)
+        except Exception:
+            pass
+    assert limiter.stats()['active'] == 0
@@ -0,0 +1,80 @@
+"""
+Отправка файлов отчётов из буферов через настоящий telegram.Bot с подменой HTTP-запросов
+"""
+
+import asyncio
+import json
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+import pytest
+from telegram import Bot
+from telegram.request import BaseRequest
+
+import broker_call_bot as bot_module
+
+
+class FakeRequest(BaseRequest):
+    """Запоминает запросы к Bot API и отвечает успешным сообщением"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        files = request_data.multipart_data if request_data else None
+        self.calls.append((url.rsplit('/', 1)[-1], files))
+        message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+        return 200, json.dumps({"ok": True, "result": message}).encode()
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+@pytest.fixture
+def sent():
+    request = FakeRequest()
+    return request, FakeContext(Bot("123:abc", request=request, get_updates_request=FakeRequest()))
+
+
+@pytest.mark.parametrize("spool_mb", [32, 0.01])
+def test_send_excel_from_buffer(sent, monkeypatch, spool_mb):
+    # 32 МБ - буфер остаётся в памяти, 0.01 МБ - переносится во временный файл
+    request, context = sent
+    monkeypatch.setattr(bot_module, "REPORT_SPOOL_MB", spool_mb)
+    df = pd.DataFrame({'Отдел': [str(i % 7) for i in range(5000)], 'Звонков': range(5000)})
+
+    asyncio.run(bot_module.send_excel(df, "report.xlsx", 1, context))
+
+    method, files = request.calls[-1]
+    filename, content, _ = files['document']
+    assert method == 'sendDocument'
+    assert filename == "report.xlsx"
+    assert content.startswith(b'PK')
+
+
+def test_send_plot_from_buffer(sent):
+    request, context = sent
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3])
+
+    asyncio.run(bot_module.send_plot(fig, 1, context))
+
+    method, files = request.calls[-1]
+    filename, content, _ = files['photo']
+    assert method == 'sendPhoto'
+    assert filename == "plot.png"
+    assert content.startswith(b'\x89PNG')
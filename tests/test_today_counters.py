@@ -0,0 +1,60 @@
+"""
+Опрос звонков за день (TodayCounters) при любом порядке звонков в ответе API
+"""
+
+import pytest
+
+from today_counters import TodayCounters
+
+
+class FakeCallsApi:
+    """Звонки за день с постраничной выдачей в заданном порядке"""
+
+    def __init__(self, newest_first):
+        self.newest_first = newest_first
+        self.calls = []
+        self.requests = 0
+
+    def add(self, count):
+        for _ in range(count):
+            number = len(self.calls)
+            self.calls.append({'id': number, 'type': 'in', 'status': 'answered', 'from': '+7 900 000-00-01',
+                               'to': f'10{number % 3}', 'start': f'2026-10-18 10:{number % 60:02d}:00'})
+
+    def fetch_page(self, day, page, page_size):
+        self.requests += 1
+        calls = self.calls[::-1] if self.newest_first else self.calls
+        return calls[(page - 1) * page_size:page * page_size]
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_poll_counts_every_call_once(newest_first):
+    api = FakeCallsApi(newest_first)
+    counters = TodayCounters(api.fetch_page, page_size=10)
+    total = 0
+    for batch in (25, 0, 3, 10, 47, 1, 0, 12):
+        api.add(batch)
+        total += batch
+        assert counters.poll() == batch
+        summaries = counters.summaries(['100', '101', '102'])
+        assert sum(summary['total'] for summary in summaries) == total
+        assert sum(summary['incoming'] for summary in summaries) == total
+
+
+@pytest.mark.parametrize("newest_first", [False, True])
+def test_poll_without_new_calls_reads_few_pages(newest_first):
+    api = FakeCallsApi(newest_first)
+    counters = TodayCounters(api.fetch_page, page_size=10)
+    api.add(95)
+    counters.poll()
+    api.requests = 0
+    assert counters.poll() == 0
+    assert api.requests <= 3
+
+
+def test_api_ignoring_page_stops():
+    api = FakeCallsApi(False)
+    api.add(10)
+    counters = TodayCounters(lambda day, page, page_size: api.fetch_page(day, 1, page_size), page_size=10)
+    assert counters.poll() == 10
+    assert counters.poll() == 0
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from call_stats import empty_summary, add_call
+from employee_data_provider import CALL_PHONE_FIELDS, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+class TodayCounters:
+    """
+    Счётчики звонков за текущий день по номерам, обновляемые опросом API
+
+    Каждый опрос запрашивает звонки всех номеров за день и учитывает только звонки, которых ещё не было
+    (по id, а без id - по времени и номерам). Порядок звонков в ответе API не предполагается:
+    новые звонки ищутся и в начале списка (страницы с первой, пока на них есть новые звонки),
+    и в конце (страницы от курсора - страницы, на которой остановился предыдущий опрос, - до последней).
+    В полночь счётчики обнуляются.
+    """
+
+    def __init__(self, fetch_page, page_size=1000):
+        """
+        Args:
+            fetch_page: Функция fetch_page(day, page, page_size), возвращающая список звонков страницы
+            page_size (int): Размер страницы
+        """
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, day):
+        self.day = day
+        self.updated_at = None
+        self._counters = {}  # нормализованный номер -> статистика
+        self._seen = set()
+        self._page = 1
+
+    @staticmethod
+    def _call_key(call):
+        call_id = call.get('id')
+        if call_id is not None:
+            return call_id
+        return (call.get('start'), call.get('from'), call.get('to'))
+
+    def _count(self, calls):
+        """Учёт звонков страницы, которых ещё не было; возвращает их количество"""
+        new_calls = [call for call in calls if self._call_key(call) not in self._seen]
+        with self._lock:
+            for call in new_calls:
+                self._seen.add(self._call_key(call))
+                phones = {normalize_phone(call.get(field)) for field in CALL_PHONE_FIELDS if call.get(field)}
+                phones.discard('')
+                for phone in phones:
+                    summary = self._counters.get(phone)
+                    if summary is None:
+                        summary = self._counters[phone] = empty_summary()
+                    add_call(summary, call)
+        return len(new_calls)
+
+    def _scan(self, day, page, until_seen):
+        """
+        Чтение страниц звонков за день начиная с page
+
+        Args:
+            day (str): День YYYY-MM-DD
+            page (int): Первая страница
+            until_seen (bool): Остановиться на полной странице без новых звонков
+
+        Returns:
+            tuple: (новых звонков, последняя прочитанная страница, дошли ли до конца списка)
+        """
+        added = 0
+        previous = None
+        while True:
+            calls = self.fetch_page(day, page, self.page_size)
+            page_added = self._count(calls)
+            added += page_added
+            if len(calls) < self.page_size:
+                return added, page, True  # последняя страница: следующий опрос продолжит с неё
+            if until_seen and not page_added:
+                return added, page, False
+            keys = [self._call_key(call) for call in calls]
+            if keys == previous:
+                logger.warning("Опрос звонков за сегодня: API вернул ту же страницу, пагинация остановлена")
+                return added, page, True
+            previous = keys
+            page += 1
+
+    def poll(self):
+        """
+        Догрузка новых звонков за текущий день
+
+        Returns:
+            int: Количество новых звонков
+        """
+        with self._poll_lock:
+            day = datetime.now().strftime("%Y-%m-%d")
+            if day != self.day:
+                with self._lock:
+                    self._reset(day)
+
+            started = time.monotonic()
+            # Новые звонки первыми: достаточно страниц с первой до страницы без новых звонков
+            added, page, finished = self._scan(day, 1, until_seen=True)
+            if not finished:
+                # Новые звонки последними: они на страницах от курсора до последней
+                more, page, _ = self._scan(day, max(page + 1, self._page), until_seen=False)
+                added += more
+
+            with self._lock:
+                self._page = page
+                self.updated_at = datetime.now()
+            logger.debug(
+                f"Опрос звонков за {day}: новых {added}, страница {page}, {(time.monotonic() - started) * 1000:.0f} мс"
+            )
+            return added
+
+    def is_fresh(self, max_age):
+        """Счётчики за текущий день обновлялись не раньше max_age секунд назад"""
+        with self._lock:
+            return (
+                self.updated_at is not None
+                and self.day == datetime.now().strftime("%Y-%m-%d")
+                and (datetime.now() - self.updated_at).total_seconds() <= max_age
+            )
+
+    def summaries(self, phones):
+        """
+        Статистика за текущий день для номеров
+
+        Returns:
+            list: {'incoming', 'outgoing', 'missed', 'total', 'talk_seconds', 'durations'} в порядке phones
+        """
+        with self._lock:
+            result = []
+            for phone in phones:
+                summary = self._counters.get(normalize_phone(phone))
+                # Копия: гистограмма продолжает пополняться опросом
+                result.append({**summary, 'durations': summary['durations'].copy()} if summary else empty_summary())
+            return result
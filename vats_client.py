@@ -0,0 +1,515 @@
+import codecs
+import json
+import logging
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Ключи конверта ответа со списком звонков
+ENVELOPE_KEYS = ('result', 'data', 'calls')
+_WHITESPACE = ' \t\n\r'
+# Хвост буфера из одних символов числа (без копирования хвоста)
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+class _JsonStream:
+    """Текстовый буфер поверх фрагментов тела ответа для разбора JSON по частям"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf-8-sig')()
+        self._decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # Дочитывает следующий фрагмент; уже разобранная часть буфера отбрасывается
+        while not self.eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.eof = True
+                text = self._text.decode(b'', final=True)
+            else:
+                text = self._text.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """Следующий значимый символ ('' в конце потока)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Некорректный JSON в ответе API: ожидался '{chars}', получен '{char}'")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Следующее JSON-значение целиком"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Число, за которым в буфере только символы числа (или ничего), может продолжаться
+            # в следующем фрагменте: '1.' разбирается как 1, '1e' - как 1
+            if not self.eof and _NUMBER_TAIL.match(self.buf, end) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+def _iter_json_array(stream):
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.pos += 1
+        return
+    while True:
+        yield stream.value()
+        if stream.expect(',]') == ']':
+            return
+
+def iter_json_calls(chunks):
+    """
+    Потоковый разбор ответа API со звонками
+
+    Конверт определяется по ходу чтения: список звонков на верхнем уровне или первый из ключей
+    result/data/calls со списком в значении. Звонки отдаются по мере поступления фрагментов,
+    поэтому в памяти находится один звонок и один фрагмент тела, а не весь ответ.
+    Остаток ответа после списка дочитывается, чтобы соединение вернулось в пул.
+
+    Args:
+        chunks: Итерируемые фрагменты тела ответа (bytes)
+
+    Yields:
+        Элемент списка звонков
+
+    Raises:
+        ValueError: Ответ не является корректным JSON
+    """
+    stream = _JsonStream(chunks)
+    first = stream.peek()
+    if first == '[':
+        yield from _iter_json_array(stream)
+        return
+    if first != '{':
+        stream.value()  # скалярный ответ: звонков нет
+        return
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.pos += 1
+        return
+    found = False
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if not found and key in ENVELOPE_KEYS and stream.peek() == '[':
+            found = True
+            yield from _iter_json_array(stream)
+        else:
+            stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+class VatsUnavailableError(Exception):
+    """API ВАТС недоступно: автомат разомкнут после серии ошибок"""
+
+class CircuitBreaker:
+    """
+    Автомат защиты для API ВАТС
+
+    После failure_threshold ошибок подряд (сетевые ошибки, таймауты, ответы 5xx) размыкается,
+    и запросы сразу завершаются VatsUnavailableError, не дожидаясь таймаутов.
+    Через reset_timeout секунд пропускается один пробный запрос (half-open):
+    успех замыкает автомат, ошибка снова размыкает его на reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_request(self):
+        """
+        Raises:
+            VatsUnavailableError: Автомат разомкнут или пробный запрос уже выполняется
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_in = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if retry_in > 0 or self._probing:
+                raise VatsUnavailableError(
+                    f"API ВАТС недоступно, повторная попытка через {max(retry_in, 0):.0f} с"
+                )
+            # Half-open: пропускаем один пробный запрос
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("API ВАТС снова доступно, автомат замкнут")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            probe_failed = self._probing
+            self._probing = False
+            if probe_failed or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                logger.warning(
+                    f"API ВАТС недоступно ({self._failures} ошибок подряд), "
+                    f"запросы приостановлены на {self.reset_timeout} с"
+                )
+
+class RateLimiter:
+    """
+    Общий для процесса ограничитель запросов к API ВАТС
+
+    Token bucket: не больше rate запросов в секунду (с запасом burst) и не больше
+    max_concurrent запросов одновременно. После ответа 429 все запросы ждут Retry-After.
+    Потоки сверх лимита ждут в очереди, её глубина периодически пишется в лог.
+    """
+
+    def __init__(self, rate, burst=None, max_concurrent=None, report_interval=10):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.max_concurrent = max_concurrent
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._report_interval = report_interval
+        self._last_report = 0.0
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self):
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.rate:
+                        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if now < self._paused_until:
+                        timeout = self._paused_until - now
+                    elif self.max_concurrent and self.active >= self.max_concurrent:
+                        timeout = None
+                    elif not self.rate or self._tokens >= 1:
+                        if self.rate:
+                            self._tokens -= 1
+                        self.active += 1
+                        return
+                    else:
+                        timeout = (1 - self._tokens) / self.rate
+                    self._report_queue(now)
+                    self._cond.wait(timeout)
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Приостановить все запросы на seconds секунд (ответ 429 с Retry-After)"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _report_queue(self, now):
+        if self.waiting > 1 and now - self._last_report >= self._report_interval:
+            self._last_report = now
+            logger.info(f"Очередь запросов к API ВАТС: ожидают {self.waiting}, выполняются {self.active}")
+
+    def stats(self):
+        """
+        Returns:
+            dict: {'waiting', 'active'}
+        """
+        with self._cond:
+            return {'waiting': self.waiting, 'active': self.active}
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+class VatsClient:
+    """
+    Общий HTTP-клиент API ВАТС
+
+    Одна сессия с пулом keep-alive соединений на весь процесс: бот, patch.py и debug_api.py
+    ходят в API через неё, поэтому TCP+TLS рукопожатие выполняется один раз на соединение пула,
+    а не на каждый запрос. Ответы запрашиваются сжатыми (gzip) и разбираются потоково.
+    """
+
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, api_key, api_url, pool_size=16, connect_timeout=5, read_timeout=30,
+                 rate_limiter=None, circuit_breaker=None, max_throttle_retries=5):
+        self.api_key = api_key
+        self.api_url = api_url.rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.max_throttle_retries = max_throttle_retries
+
+        # Сессия с пулом соединений и ретраями ответов 5xx с экспоненциальной паузой
+        # (429 обрабатывается в get через общий ограничитель, а не в адаптере).
+        # Ошибки соединения и таймауты не повторяются: каждая сразу учитывается автоматом защиты,
+        # а запрос к зависшему API не ждёт несколько таймаутов подряд
+        self._session = requests.Session()
+        retries = Retry(
+            total=3,
+            connect=0,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retries)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # gzip распаковывается по мере чтения в iter_content
+        self._session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': 'gzip, deflate'})
+        self._timeout = (connect_timeout, read_timeout)  # (connect, read)
+
+    def get(self, path, params=None, headers=None, timeout=None, stream=False):
+        """
+        GET-запрос к API ВАТС через общую сессию
+
+        Args:
+            path (str): Путь относительно API_URL, например 'calls'
+            params (dict): Параметры запроса
+            headers (dict): Дополнительные заголовки
+            timeout: Таймаут (connect, read); по умолчанию настройки клиента
+            stream (bool): Не читать тело сразу; тело ответа 200 читается через iter_body, после чтения ответ
+                закрывается через close_response (до этого за ним остаётся слот ограничителя)
+
+        Returns:
+            requests.Response: Ответ API
+
+        Raises:
+            VatsUnavailableError: API недоступно (автомат защиты разомкнут)
+        """
+        url = f"{self.api_url}/{path.lstrip('/')}"
+        breaker = self.circuit_breaker
+        for attempt in range(self.max_throttle_retries + 1):
+            if breaker is not None:
+                breaker.before_request()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            holds_slot = False
+            try:
+                started = time.monotonic()
+                response = self._session.get(
+                    url, params=params, headers=headers, timeout=timeout or self._timeout, stream=stream
+                )
+                logger.debug(f"GET {path}: {response.status_code} за {(time.monotonic() - started) * 1000:.0f} мс")
+                # Тело потокового ответа 200 загружается после возврата из get: слот ограничителя
+                # освобождается в close_response, иначе max_concurrent не ограничивал бы загрузку тел
+                holds_slot = stream and response.status_code == 200 and self.rate_limiter is not None
+                response.holds_rate_slot = holds_slot
+            except requests.exceptions.RequestException:
+                if breaker is not None:
+                    breaker.record_failure()
+                raise
+            finally:
+                if self.rate_limiter is not None and not holds_slot:
+                    self.rate_limiter.release()
+            if breaker is not None:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                elif not stream or response.status_code != 200:
+                    # Тело потокового ответа 200 ещё не прочитано: исход запроса учитывает iter_body
+                    breaker.record_success()
+            if response.status_code != 429 or attempt == self.max_throttle_retries:
+                return response
+            response.close()
+            delay = self._retry_after(response, default=2 ** attempt)
+            logger.warning(f"API ВАТС ограничил частоту запросов (429), пауза {delay:.1f} с")
+            if self.rate_limiter is not None:
+                self.rate_limiter.pause(delay)
+            else:
+                time.sleep(delay)
+        return response
+
+    def iter_body(self, response):
+        """
+        Фрагменты тела потокового ответа (get с stream=True)
+
+        Для автомата защиты запрос завершается вместе с телом: обрыв соединения или таймаут
+        посреди тела - ошибка, тело дочитано до конца - успех. Чтение, прекращённое
+        потребителем без ошибок (генератор закрыт), тоже считается успехом.
+
+        Args:
+            response (requests.Response): Ответ get(..., stream=True)
+
+        Yields:
+            bytes: Фрагменты тела по STREAM_CHUNK_SIZE
+        """
+        breaker = self.circuit_breaker
+        try:
+            yield from response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+        except requests.exceptions.RequestException:
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        except GeneratorExit:
+            if breaker is not None:
+                breaker.record_success()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+
+    def close_response(self, response):
+        """Закрытие ответа get: соединение возвращается в пул, слот ограничителя освобождается"""
+        try:
+            response.close()
+        finally:
+            if getattr(response, 'holds_rate_slot', False):
+                response.holds_rate_slot = False
+                self.rate_limiter.release()
+
+    @staticmethod
+    def _retry_after(response, default):
+        # Retry-After: число секунд или HTTP-дата
+        value = response.headers.get('Retry-After')
+        if not value:
+            return default
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
+
+    def iter_calls(self, start_date, end_date, phone_number, page_size=1000):
+        """
+        Постраничное получение истории звонков
+
+        Генератор запрашивает страницы по page_size записей, пока период не будет исчерпан,
+        и отдаёт звонки по одному по мере чтения ответа: страница не загружается в память целиком.
+
+        Args:
+            start_date (str): Дата начала в формате YYYY-MM-DD
+            end_date (str): Дата окончания в формате YYYY-MM-DD
+            phone_number (str): Номер телефона сотрудника; None - звонки всех номеров за период
+            page_size (int): Количество записей на странице
+
+        Yields:
+            dict: Звонок
+
+        Raises:
+            requests.exceptions.RequestException: При сетевой ошибке или ответе с кодом не 200
+            ValueError: Ответ не является корректным JSON
+        """
+        page = 1
+        first_page_id = None
+        while True:
+            count = 0
+            repeated = False
+            for call in self._iter_page(start_date, end_date, phone_number, page, page_size):
+                if count == 0:
+                    # Защита от зацикливания, если API игнорирует параметр page
+                    page_id = call.get('id') if isinstance(call, dict) else None
+                    if page == 1:
+                        first_page_id = page_id
+                    elif page_id is not None and page_id == first_page_id:
+                        logger.warning(f"API вернул первую страницу повторно для {phone_number or 'всех номеров'}, пагинация остановлена")
+                        repeated = True
+                        break
+                count += 1
+                yield call
+
+            if repeated:
+                break
+            logger.debug(f"Страница {page}: {count} звонков для {phone_number or 'всех номеров'}")
+            if count < page_size:
+                break
+            page += 1
+
+    def _iter_page(self, start_date, end_date, phone_number, page, page_size):
+        params = {
+            'api_key': self.api_key,
+            'start_date': start_date,
+            'end_date': end_date,
+            'limit': page_size,
+            'page': page
+        }
+        if phone_number:
+            params['phone'] = phone_number
+        response = self.get('calls', params=params, stream=True)
+        try:
+            if response.status_code != 200:
+                raise requests.exceptions.HTTPError(
+                    f"Ошибка API {response.status_code}: {response.text}", response=response
+                )
+            yield from iter_json_calls(self.iter_body(response))
+        finally:
+            self.close_response(response)
+
+    def get_calls_page(self, start_date, end_date, phone_number, page, page_size=1000):
+        """
+        Одна страница истории звонков
+
+        Args:
+            page (int): Номер страницы, начиная с 1
+
+        Returns:
+            list: Звонки страницы (меньше page_size - страница последняя)
+        """
+        return list(self._iter_page(start_date, end_date, phone_number, page, page_size))
+
+    def get_calls(self, start_date, end_date, phone_number, page_size=1000):
+        """
+        Получение всей истории звонков за период списком
+
+        Returns:
+            list: Список звонков
+        """
+        return list(self.iter_calls(start_date, end_date, phone_number, page_size))
+
+    def close(self):
+        self._session.close()